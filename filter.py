@@ -7,6 +7,13 @@ from pydantic import BaseModel, Field
 from typing import Callable, Awaitable, Any, Optional, Literal
 import logging
 import os
+import base64
+import asyncio
+import hashlib
+import shutil
+import tempfile
+import numpy as np
+import cv2
 
 from open_webui.utils.misc import get_last_user_message_item
 
@@ -28,21 +35,111 @@ def setup_logger():
 
 logger = setup_logger()
 
+IMAGE_DIR = "/app/backend/data/images"
+
+
+# Images are stored as <namespace>/<source> with the outputs derived from them in <namespace>/<source>/.
+# mcp/storage.py only accepts names of this form, keep its NAMESPACE and NAME patterns in sync.
+def namespace(key: str) -> str:
+    """
+    Get the namespace folder of a chat or user
+    key: the chat id, or the user id if there is no chat
+    returns a 12 character hex string
+    """
+    return hashlib.sha256(key.encode()).hexdigest()[:12]
+
+
+def source_name(space: str, digest: str) -> str:
+    """
+    Get the file name of an uploaded image, unique per image content within a namespace
+    space: the namespace
+    digest: sha256 hex digest of the uploaded image
+    returns the file name passed to the tools
+    """
+    return f"{space}/img{digest[:12]}"
+
+
+def trim_namespace(folder: str, keep: int):
+    """
+    Remove the oldest uploaded images of a namespace and the outputs derived from them
+    folder: the namespace folder
+    keep: the number of images to keep
+    """
+    sources = [
+        entry
+        for entry in os.scandir(folder)
+        if entry.is_file() and entry.name.endswith((".npy", ".txt"))
+    ]
+    sources.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+    for entry in sources[keep:]:
+        base = os.path.splitext(entry.path)[0]
+        logger.info(f"removing {base}")
+        try:
+            os.remove(entry.path)
+        except OSError:  # already removed
+            pass
+        shutil.rmtree(base, ignore_errors=True)  # outputs of the image
+
+
+def write_atomic(path: str, write: Callable[[Any], None], mode: str = "wb"):
+    """
+    Write a file through a temporary file and rename it into place,
+    so readers never see a half-written file
+    path: the file path
+    write: function writing the contents to an open file
+    mode: the file mode
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, mode) as file:
+            write(file)
+        os.chmod(tmp, 0o644)  # mkstemp files are private, the MCP server must be able to read it
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def store_image(path: str, encoded: str, raw: bool = True):
+    """
+    Store an uploaded image for the MCP server
+    path: path to the image file without its extension
+    encoded: base64 image string
+    raw: store the decoded RGB pixels as .npy (shape and dtype header + raw data) so the MCP tools
+    can memory-map it. Falls back to base64 .txt if the image can not be decoded
+    """
+    if raw:
+        data = np.frombuffer(base64.b64decode(encoded), np.uint8)
+        img = cv2.imdecode(data, cv2.IMREAD_COLOR)
+        if img is not None:
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+            write_atomic(path + ".npy", lambda file: np.save(file, img))
+            if os.path.exists(path + ".txt"):  # names are reused, don't leave an older image behind
+                os.remove(path + ".txt")
+            return
+        logger.info("could not decode image, storing base64")
+    write_atomic(path + ".txt", lambda file: file.write(encoded), "w")
+    if os.path.exists(path + ".npy"):
+        os.remove(path + ".npy")
+
 
 class Filter:
     class Valves(BaseModel):
         max_images: int = Field(
             default=10,
-            description="Maximum number of images to store in memory",
+            description="Maximum number of images kept per conversation, the oldest images and their outputs are removed",
+        )
+        store_raw: bool = Field(
+            default=True,
+            description="Store decoded pixels as a memory-mappable .npy array instead of base64 text",
         )
 
         pass
 
     def __init__(self):
-        if not os.path.exists("/app/backend/data/images"):
-            os.makedirs("/app/backend/data/images")
+        if not os.path.exists(IMAGE_DIR):
+            os.makedirs(IMAGE_DIR)
         self.valves = self.Valves()
-        self.count = 0
         pass
 
     async def inlet(
@@ -51,10 +148,9 @@ class Filter:
         __event_emitter__: Callable[[Any], Awaitable[None]],
         __model__: Optional[dict] = None,
         __user__: Optional[dict] = None,
+        __metadata__: Optional[dict] = None,
     ) -> dict:
         logger.info(f"path: {os.path.abspath(__file__)}")
-        if self.count >= self.valves.max_images:
-            self.count = 0
         messages = body.get("messages")
         if messages is None:
             # Handle the case where messages is None
@@ -91,17 +187,34 @@ class Filter:
         if has_images:
             ims = []
             try:
+                # each chat gets its own folder, so concurrent users never share names
+                key = (
+                    (__metadata__ or {}).get("chat_id")
+                    or body.get("chat_id")
+                    or (__user__ or {}).get("id")
+                    or "shared"
+                )
+                space = namespace(key)
+                folder = os.path.join(IMAGE_DIR, space)
+                os.makedirs(folder, exist_ok=True)
                 for image in images:
                     logger.info("parsing image")
                     header, encoded = image.split(",", 1)
-                    with open(
-                        f"/app/backend/data/images/image{self.count}.txt", "w"
-                    ) as file:
+                    digest = hashlib.sha256(encoded.encode()).hexdigest()
+                    name = source_name(space, digest)
+                    path = os.path.join(IMAGE_DIR, name)
+                    stored = [p for p in (path + ".npy", path + ".txt") if os.path.exists(p)]
+                    if stored:  # same image uploaded again in this chat
+                        logger.info(f"image already stored as {name}")
+                        os.utime(stored[0])  # mark as recently used
+                    else:
                         logger.info("writing to file")
-                        file.write(encoded)
+                        await asyncio.to_thread(
+                            store_image, path, encoded, self.valves.store_raw
+                        )
                         logger.info("file written")
-                    ims.append(f"image{self.count}")
-                    self.count += 1
+                    ims.append(name)
+                await asyncio.to_thread(trim_namespace, folder, self.valves.max_images)
                 logger.info(f"sending message: {msg}")
                 msg[-1]["text"] += f"The image files are: {ims}"
                 logger.info(f"sending message: {msg}")
@@ -0,0 +1,134 @@
+import os
+import time
+import logging
+from types import SimpleNamespace
+
+logger = logging.getLogger(__name__)
+
+BACKEND = os.environ.get("SEGMENT_BACKEND", "torch") # torch, torch-int8, onnx or onnx-int8
+BACKENDS = ["torch", "torch-int8", "onnx", "onnx-int8"]
+ONNX_DIR = os.environ.get("ONNX_DIR", "cache/onnx") # exported models, reused across restarts
+THREADS = int(os.environ.get("INFERENCE_THREADS", 0)) # 0 for the runtime default of one thread per core
+
+
+class TorchBackend:
+    """
+    Runs the layout model in eager PyTorch on the CPU, optionally with int8 dynamically quantised linear layers
+    """
+
+    def __init__(self, model, quantize: bool = False):
+        import torch
+        if THREADS > 0:
+            torch.set_num_threads(THREADS)
+        if quantize:
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        self.model = model
+
+    def __call__(self, pixel_values):
+        """
+        pixel_values: float tensor of shape (batch, 3, height, width) from the image processor
+        returns the outputs with logits and pred_boxes tensors
+        """
+        import torch
+        with torch.inference_mode():
+            outputs = self.model(pixel_values=pixel_values)
+        return SimpleNamespace(logits=outputs.logits, pred_boxes=outputs.pred_boxes)
+
+
+class OnnxBackend:
+    """
+    Runs an exported layout model with ONNX Runtime on the CPU
+    """
+
+    def __init__(self, path: str):
+        import onnxruntime as ort # optional, only needed for the onnx backends
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if THREADS > 0:
+            options.intra_op_num_threads = THREADS
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+    def __call__(self, pixel_values):
+        """
+        pixel_values: float tensor of shape (batch, 3, height, width) from the image processor
+        returns the outputs with logits and pred_boxes tensors
+        """
+        import torch
+        logits, boxes = self.session.run(["logits", "pred_boxes"], {"pixel_values": pixel_values.numpy()})
+        return SimpleNamespace(logits=torch.from_numpy(logits), pred_boxes=torch.from_numpy(boxes))
+
+
+def onnx_path(name: str, quantize: bool = False):
+    """
+    Gets the path of an exported model
+    name: the huggingface model name or path
+    quantize: the int8 variant
+    returns the path of the .onnx file
+    """
+    safe = name.strip("/").replace("/", "--")
+    return os.path.join(ONNX_DIR, safe + (".int8.onnx" if quantize else ".onnx"))
+
+
+def export_onnx(model, path: str):
+    """
+    Exports the layout model to ONNX with a dynamic batch size and input resolution
+    model: the eager RTDetrV2ForObjectDetection model
+    path: where to write the .onnx file
+    """
+    import torch
+
+    class Outputs(torch.nn.Module): # plain tensor outputs for the exporter
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, pixel_values):
+            outputs = self.model(pixel_values=pixel_values)
+            return outputs.logits, outputs.pred_boxes
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = path + ".tmp"
+    start = time.time()
+    with torch.no_grad():
+        torch.onnx.export(Outputs(model), (torch.rand(1, 3, 640, 640),), tmp, input_names=["pixel_values"],
+                          output_names=["logits", "pred_boxes"], opset_version=17, dynamo=False,
+                          dynamic_axes={"pixel_values": {0: "batch", 2: "height", 3: "width"}, "logits": {0: "batch"}, "pred_boxes": {0: "batch"}})
+    os.replace(tmp, path) # never load a partial export
+    logger.info(f"exported {path} in {round(time.time() - start, 2)}s")
+
+
+def quantize_onnx(src: str, dst: str):
+    """
+    Quantises the weights of an exported model to int8. Only the transformer matrix multiplications are quantised,
+    int8 convolutions are slower than float ones on most CPUs
+    src: the float .onnx file
+    dst: where to write the int8 .onnx file
+    """
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    tmp = dst + ".tmp"
+    quantize_dynamic(src, tmp, weight_type=QuantType.QInt8, op_types_to_quantize=["MatMul", "Gemm"])
+    os.replace(tmp, dst)
+    logger.info(f"quantised {dst}")
+
+
+def load_backend(name: str, load_model, backend: str = BACKEND):
+    """
+    Creates an inference backend for the layout model, exporting and quantising it on first use
+    name: the huggingface model name or path, used to name exported files
+    load_model: function returning the eager RTDetrV2ForObjectDetection model, not called once the model is exported
+    backend: torch, torch-int8, onnx or onnx-int8
+    returns a callable taking pixel values and returning outputs with logits and pred_boxes
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"unknown backend {backend}, use one of {BACKENDS}")
+    if backend.startswith("torch"):
+        return TorchBackend(load_model(), quantize=backend == "torch-int8")
+    path = onnx_path(name)
+    if not os.path.exists(path):
+        export_onnx(load_model(), path)
+    if backend == "onnx-int8":
+        quantized = onnx_path(name, quantize=True)
+        if not os.path.exists(quantized):
+            quantize_onnx(path, quantized)
+        path = quantized
+    return OnnxBackend(path)
@@ -0,0 +1,76 @@
+import os
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = int(os.environ.get("SEGMENT_BATCH_SIZE", 4)) # max images per forward pass
+BATCH_WINDOW = float(os.environ.get("SEGMENT_BATCH_WINDOW", 0.05)) # seconds to wait for more requests
+
+
+class Batcher:
+    """
+    Micro-batching scheduler for model inference.
+    Requests submitted while a batch is forming are grouped (up to batch_size, or until window seconds pass)
+    and run together with one call to run() in a worker thread, so the event loop is never blocked by the model.
+    """
+
+    def __init__(self, run, batch_size: int = BATCH_SIZE, window: float = BATCH_WINDOW):
+        """
+        run: function taking a list of inputs and returning a list of results in the same order
+        batch_size: the maximum number of inputs per batch
+        window: the number of seconds to wait for a batch to fill
+        """
+        self.run = run
+        self.batch_size = batch_size
+        self.window = window
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="batcher")
+        self.queue = None
+        self.worker = None
+
+    async def submit(self, item):
+        """
+        Queues an input for the next batch
+        item: the model input
+        returns the result for the input
+        """
+        loop = asyncio.get_running_loop()
+        if self.worker is None or self.worker.done():
+            self.queue = asyncio.Queue()
+            self.worker = loop.create_task(self._loop())
+        future = loop.create_future()
+        await self.queue.put((item, future))
+        return await future
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.window
+        while len(batch) < self.batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return [(item, future) for item, future in batch if not future.done()] # drop cancelled requests
+
+    async def _loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            if len(batch) == 0:
+                continue
+            logger.info(f"running batch of {len(batch)}")
+            try:
+                results = await loop.run_in_executor(self.executor, self.run, [item for item, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
@@ -0,0 +1,285 @@
+"""
+Benchmarks the MCP image tools on synthetic document images.
+
+Runs every tool directly against a temporary images/ directory and reports p50/p99 latency,
+peak RSS and throughput per tool and resolution as JSON.
+
+command to run: python benchmark.py --sizes 256 1024 4096 --tiny-model --output bench.json
+compare against a previous run: python benchmark.py --baseline bench.json
+"""
+import os
+import sys
+import json
+import time
+import base64
+import asyncio
+import logging
+import argparse
+import tempfile
+import threading
+import resource
+import numpy as np
+import cv2
+
+logger = logging.getLogger(__name__)
+
+SIZES = [256, 1024, 2048, 4096, 7680]
+TOOLS = ["correct", "simulate", "crop", "resize", "visualize_segmentaton", "get_specific_segment", "segment"]
+
+
+def synthetic_page(size: int, seed: int = 0):
+    """
+    Draws a synthetic document page
+    size: the width of the page in pixels, the height is 1.3x the width
+    seed: random seed
+    returns the uint8 rgb image and its layout boxes in the format of [(label, [score, [box]])...]
+    """
+    rng = np.random.default_rng(seed)
+    w, h = size, int(size * 1.3)
+    img = np.full((h, w, 3), 255, np.uint8)
+    boxes = []
+    margin = w // 16
+    y = margin
+    scale = max(w / 1000, 0.2)
+    while y < h - margin:
+        kind = rng.choice(["Text", "Text", "Table", "Picture"])
+        bh = int(rng.integers(h // 30, h // 8))
+        box = [margin, y, w - margin, min(y + bh, h - margin)]
+        if kind == "Picture": # coloured figure
+            img[box[1]:box[3], box[0]:box[2]] = rng.integers(0, 256, 3)
+        elif kind == "Table": # grid
+            for gx in np.linspace(box[0], box[2], 5).astype(int):
+                cv2.line(img, (gx, box[1]), (gx, box[3]), (0, 0, 0), max(1, int(scale)))
+            for gy in np.linspace(box[1], box[3], 4).astype(int):
+                cv2.line(img, (box[0], gy), (box[2], gy), (0, 0, 0), max(1, int(scale)))
+        else: # text lines
+            for ty in range(box[1] + int(20 * scale), box[3], max(1, int(24 * scale))):
+                cv2.putText(img, "lorem ipsum dolor sit amet " * 4, (box[0], ty), cv2.FONT_HERSHEY_PLAIN, scale, (30, 30, 30), 1)
+        boxes.append([kind, [1.0, box]])
+        y = box[3] + int(rng.integers(h // 100 + 1, h // 30 + 2))
+    return img, boxes
+
+
+def write_image(directory: str, name: str, img: np.ndarray, fmt: str):
+    """
+    Stores an image the way the Open WebUI filter does
+    directory: the images directory
+    name: the image file name
+    img: uint8 rgb image
+    fmt: "txt" for base64 png, "npy" for the raw array
+    """
+    path = os.path.join(directory, name)
+    if fmt == "npy":
+        np.save(path + ".npy", img)
+    else:
+        ok, buf = cv2.imencode(".png", cv2.cvtColor(img, cv2.COLOR_RGB2BGR))
+        with open(path + ".txt", "w") as f:
+            f.write(base64.b64encode(buf.tobytes()).decode())
+
+
+def tiny_model(directory: str):
+    """
+    Saves a small randomly initialised RT-DETR model so segment can be benchmarked offline
+    directory: where to save the model
+    returns the model path
+    """
+    from transformers import RTDetrV2Config, RTDetrV2ForObjectDetection, RTDetrImageProcessor
+    config = RTDetrV2Config(num_labels=17, decoder_layers=2, num_queries=100)
+    RTDetrV2ForObjectDetection(config).save_pretrained(directory)
+    RTDetrImageProcessor().save_pretrained(directory)
+    return directory
+
+
+class RssSampler:
+    """
+    Samples the resident set size in a background thread to find the peak during a block of code
+    """
+
+    def __init__(self, interval: float = 0.002):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+
+    def _rss(self):
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except OSError: # not linux, fall back to the process lifetime peak
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self._rss())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = self._rss()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self._rss())
+
+
+def tool_args(tool: str, file: str, shape: tuple):
+    """
+    Gets the benchmark arguments of a tool
+    tool: the tool name
+    file: the image file name
+    shape: the image shape
+    returns a dictionary of arguments
+    """
+    h, w = shape[:2]
+    return {
+        "correct": {"file": file},
+        "simulate": {"file": file, "color": "protanopia", "degree": 1.0},
+        "crop": {"file": file, "top": h // 4, "bottom": 3 * h // 4, "left": w // 4, "right": 3 * w // 4},
+        "resize": {"file": file, "size": [w // 2, h // 2]},
+        "visualize_segmentaton": {"file": file},
+        "get_specific_segment": {"file": file, "label": "Text"},
+        "segment": {"file": file},
+    }[tool]
+
+
+def percentile(values: list, q: float):
+    return float(np.percentile(values, q)) if values else None
+
+
+async def bench_tool(mcp, tools, tool: str, file: str, shape: tuple, boxes: list, repeat: int, cold: bool, memo: bool = False):
+    """
+    Times repeated calls of one tool
+    returns a dictionary of results
+    """
+    from store import store
+    args = tool_args(tool, file, shape)
+    latencies = []
+    errors = 0
+    with RssSampler() as rss:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            if cold: # include reading and decoding the image
+                store.invalidate(file)
+            if not memo: # always compute the output
+                tools.outputs.clear()
+            if tool == "segment":
+                tools.segcache.clear() # always run the model
+            elif tool in ("visualize_segmentaton", "get_specific_segment"):
+                key, cached = tools.lookup_segments(file)
+                if cached is None:
+                    tools.segcache.put(key, boxes) # use the synthetic layout
+            t = time.perf_counter()
+            result = await mcp.call_tool(tool, args)
+            latencies.append(time.perf_counter() - t)
+            text = " ".join(getattr(c, "text", "") for c in result.content)
+            if "error" in text.lower() or "not found" in text.lower():
+                errors += 1
+                logger.info(f"{tool} {file}: {text[:200]}")
+        total = time.perf_counter() - start
+    return {
+        "tool": tool,
+        "size": shape[1],
+        "shape": list(shape),
+        "repeat": repeat,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "mean_ms": round(float(np.mean(latencies)) * 1000, 3),
+        "peak_rss_mb": round(rss.peak / 2**20, 1),
+        "calls_per_s": round(repeat / total, 3),
+        "mpix_per_s": round(repeat * shape[0] * shape[1] / 1e6 / total, 3),
+        "errors": errors,
+    }
+
+
+async def run(args):
+    from fastmcp import FastMCP
+    import tools
+    from models import ModelManager
+    if args.tiny_model:
+        path = tiny_model(os.path.join(args.workdir, "tiny-rtdetr"))
+        tools.model_name = path
+        tools.models = ModelManager(path)
+    mcp = FastMCP("benchmark")
+    await tools.initialize_tools(mcp)
+    results = []
+    for size in args.sizes:
+        img, boxes = synthetic_page(size)
+        file = f"bench{size}"
+        write_image("images", file, img, args.format)
+        for tool in args.tools:
+            if tool == "segment" and not args.tiny_model and args.skip_model:
+                continue
+            await mcp.call_tool(tool, tool_args(tool, file, img.shape)) # warm up, loads the model for segment
+            result = await bench_tool(mcp, tools, tool, file, img.shape, boxes, args.repeat if tool != "segment" else args.segment_repeat, args.cold, args.memo)
+            logger.info(json.dumps(result))
+            print(f"{tool:24s} {size:6d}px  p50 {result['p50_ms']:10.2f} ms  p99 {result['p99_ms']:10.2f} ms  "
+                  f"rss {result['peak_rss_mb']:8.1f} MB  {result['calls_per_s']:8.2f} calls/s  errors {result['errors']}")
+            results.append(result)
+    return results
+
+
+def compare(results: list, baseline: list, tolerance: float):
+    """
+    Finds latency regressions against a previous run
+    results: the current results
+    baseline: the previous results
+    tolerance: allowed relative increase of p50 latency
+    returns a list of regression messages
+    """
+    previous = {(r["tool"], r["size"]): r for r in baseline}
+    regressions = []
+    for r in results:
+        old = previous.get((r["tool"], r["size"]))
+        if old is not None and r["p50_ms"] > old["p50_ms"] * (1 + tolerance):
+            regressions.append(f"{r['tool']} at {r['size']}px: p50 {old['p50_ms']} -> {r['p50_ms']} ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the MCP image tools on synthetic images")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="image widths in pixels")
+    parser.add_argument("--tools", nargs="+", default=TOOLS, choices=TOOLS, help="tools to benchmark")
+    parser.add_argument("--repeat", type=int, default=20, help="calls per tool and size")
+    parser.add_argument("--segment-repeat", type=int, default=3, help="calls of segment per size")
+    parser.add_argument("--format", choices=["txt", "npy"], default="npy", help="stored image format")
+    parser.add_argument("--cold", action="store_true", help="invalidate the decoded image cache before every call")
+    parser.add_argument("--memo", action="store_true", help="keep memoized outputs of correct, simulate, crop and resize between calls")
+    parser.add_argument("--tiny-model", action="store_true", help="use a small randomly initialised RT-DETR model (offline)")
+    parser.add_argument("--skip-model", action="store_true", help="skip segment unless --tiny-model is given")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="previous JSON results to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative p50 increase over the baseline")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, here)
+    output = os.path.abspath(args.output) if args.output else None
+    baseline = os.path.abspath(args.baseline) if args.baseline else None
+    with tempfile.TemporaryDirectory() as workdir:
+        args.workdir = workdir
+        os.environ.setdefault("SEGMENT_CACHE_PATH", os.path.join(workdir, "cache", "segments.db"))
+        os.environ.setdefault("OUTPUT_CACHE_PATH", os.path.join(workdir, "cache", "outputs.db"))
+        os.chdir(workdir) # tools read and write images/ relative to the working directory
+        os.makedirs("images")
+        results = asyncio.run(run(args))
+
+    report = {"python": sys.version.split()[0], "cpus": os.cpu_count(), "format": args.format, "cold": args.cold, "memo": args.memo, "results": results}
+    if output:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report))
+    if baseline:
+        with open(baseline) as f:
+            regressions = compare(results, json.load(f)["results"], args.tolerance)
+        for r in regressions:
+            print(f"regression: {r}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
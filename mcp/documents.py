@@ -0,0 +1,77 @@
+import os
+import logging
+import threading
+import numpy as np
+from metrics import metrics
+from storage import check_name, write_atomic
+
+logger = logging.getLogger(__name__)
+
+IMAGE_DIR = "images"
+MAX_DPI = int(os.environ.get("PDF_MAX_DPI", 300)) # pages are never rendered at a higher resolution
+_pdfium = threading.Lock() # pdfium is not thread safe
+
+
+def pdf_path(pdf: str):
+    """
+    Gets the path of a PDF in the images folder
+    pdf: the PDF file name, with or without .pdf
+    returns the path to the file
+    """
+    name = pdf[:-4] if pdf.lower().endswith(".pdf") else pdf
+    return os.path.join(IMAGE_DIR, check_name(name) + ".pdf")
+
+
+def page_names(pdf: str, count: int):
+    """
+    Gets the image file names used for the pages of a PDF
+    pdf: the PDF file name
+    count: the number of pages
+    returns a list of image file names
+    """
+    name = check_name(pdf[:-4] if pdf.lower().endswith(".pdf") else pdf)
+    return [f"{name}_page{i + 1}" for i in range(count)]
+
+
+def page_count(pdf: str):
+    """
+    Counts the pages of a PDF without rendering them
+    pdf: the PDF file name
+    returns the number of pages
+    """
+    import pypdfium2 as pdfium # optional, only needed for PDF input
+    with _pdfium:
+        doc = pdfium.PdfDocument(pdf_path(pdf))
+        try:
+            return len(doc)
+        finally:
+            doc.close()
+
+
+def render_page(pdf: str, index: int, file: str, dpi: int = 150):
+    """
+    Rasterises one page of a PDF and stores it as an image the MCP tools can read.
+    Pages that were already rendered from the current PDF are not rendered again
+    pdf: the PDF file name
+    index: the page index, starting at 0
+    file: the image file name to store the page as
+    dpi: the resolution to render at, at most MAX_DPI
+    returns the image file name
+    """
+    import pypdfium2 as pdfium
+    if dpi <= 0:
+        raise ValueError(f"invalid dpi {dpi}")
+    dpi = min(dpi, MAX_DPI)
+    path = os.path.join(IMAGE_DIR, check_name(file) + ".npy")
+    if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(pdf_path(pdf)):
+        return file
+    with metrics.stage("rasterize"), _pdfium:
+        doc = pdfium.PdfDocument(pdf_path(pdf))
+        try:
+            page = doc[index]
+            img = np.asarray(page.render(scale=dpi / 72).to_pil().convert("RGB"))
+            page.close()
+        finally:
+            doc.close()
+    write_atomic(path, lambda f: np.save(f, img)) # readers never see a partial page
+    return file
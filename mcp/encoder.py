@@ -0,0 +1,143 @@
+import os
+import logging
+import numpy as np
+import cv2
+from metrics import metrics
+from storage import write_atomic
+
+logger = logging.getLogger(__name__)
+
+IMAGE_DIR = "images"
+IMAGE_URL = os.environ.get("IMAGE_URL", "http://localhost:8004") # where the httpd container serves images/
+FORMAT = os.environ.get("OUTPUT_FORMAT", "jpg") # jpg, webp or png
+JPEG_QUALITY = int(os.environ.get("JPEG_QUALITY", 90))
+JPEG_PROGRESSIVE = os.environ.get("JPEG_PROGRESSIVE", "1") == "1" # browsers show progressive jpegs before they finish loading
+WEBP_QUALITY = int(os.environ.get("WEBP_QUALITY", 80))
+PNG_COMPRESSION = int(os.environ.get("PNG_COMPRESSION", 1)) # 0-9, low values encode much faster
+PREVIEW_PIXELS = int(os.environ.get("PREVIEW_PIXELS", 4_000_000)) # outputs above this are downscaled unless full resolution is requested, 0 to disable
+
+
+def extension(fmt: str = FORMAT):
+    """
+    Gets the file extension of an output format
+    fmt: jpg, jpeg, webp or png
+    returns the extension without the dot
+    """
+    fmt = fmt.lower().lstrip(".")
+    if fmt == "jpeg":
+        fmt = "jpg"
+    if fmt not in ("jpg", "webp", "png"):
+        raise ValueError(f"unsupported output format {fmt}, use jpg, webp or png")
+    return fmt
+
+
+def params(fmt: str = FORMAT):
+    """
+    Gets the cv2.imencode parameters of an output format
+    fmt: jpg, webp or png
+    returns a list of cv2 flags and values
+    """
+    fmt = extension(fmt)
+    if fmt == "jpg":
+        return [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY, cv2.IMWRITE_JPEG_PROGRESSIVE, int(JPEG_PROGRESSIVE), cv2.IMWRITE_JPEG_OPTIMIZE, 0]
+    if fmt == "webp":
+        return [cv2.IMWRITE_WEBP_QUALITY, WEBP_QUALITY]
+    return [cv2.IMWRITE_PNG_COMPRESSION, PNG_COMPRESSION]
+
+
+def preview_scale(shape: tuple, pixels: int = PREVIEW_PIXELS):
+    """
+    Gets the factor an image is downscaled by for its preview
+    shape: the image shape (h, w, ...)
+    pixels: the maximum number of pixels, 0 to keep the image as is
+    returns a float, 1 if the image is small enough
+    """
+    h, w = shape[:2]
+    if pixels <= 0 or h * w <= pixels:
+        return 1
+    return float(np.sqrt(pixels / (h * w)))
+
+
+def preview_note(shape: tuple):
+    """
+    Gets the note added to the link of a downscaled output
+    shape: the original image shape (h, w, ...)
+    """
+    return f"\n(preview downscaled from {shape[1]}x{shape[0]}, request full_resolution for the original size)"
+
+
+def preview(img: np.ndarray, pixels: int = PREVIEW_PIXELS):
+    """
+    Downscales an image to at most a number of pixels, keeping the aspect ratio
+    img: uint8 image
+    pixels: the maximum number of pixels, 0 to keep the image as is
+    returns the downscaled image or the image itself if it is small enough
+    """
+    h, w = img.shape[:2]
+    s = preview_scale(img.shape, pixels)
+    if s == 1:
+        return img
+    return cv2.resize(img, (max(1, int(w * s)), max(1, int(h * s))), interpolation=cv2.INTER_AREA)
+
+
+def encode(img: np.ndarray, fmt: str = FORMAT):
+    """
+    Encodes an image
+    img: uint8 bgr image
+    fmt: jpg, webp or png
+    returns the encoded bytes as a np.array
+    """
+    ok, buf = cv2.imencode("." + extension(fmt), img, params(fmt))
+    if not ok:
+        raise ValueError(f"could not encode image as {fmt}")
+    return buf
+
+
+def write(name: str, buf):
+    """
+    Writes encoded bytes to the images folder, readers never see a partial file
+    name: the file name including the extension, relative to the images folder
+    buf: the encoded bytes
+    """
+    write_atomic(os.path.join(IMAGE_DIR, name), lambda f: f.write(buf)) # creates the outputs folder of the source image
+
+
+def url(name: str):
+    """
+    Gets the link httpd serves a file of the images folder at
+    name: the file name including the extension
+    """
+    return f"{IMAGE_URL}/{name}"
+
+
+def save(img: np.ndarray, name: str, full: bool = False, fmt: str = FORMAT, pixels: int = PREVIEW_PIXELS):
+    """
+    Encodes and stores an output image, downscaled to a preview if it is large.
+    The full resolution image is stored next to the preview as <name>_full so both stay available
+    img: uint8 bgr image
+    name: the file name without the extension
+    full: keep the full resolution
+    fmt: jpg, webp or png
+    pixels: the maximum number of pixels of the preview, 0 to never downscale
+    returns the image link formatted in markdown
+    """
+    out = img if full else preview(img, pixels)
+    if full and 0 < pixels < img.shape[0] * img.shape[1]: # a preview may exist under the plain name
+        name += "_full"
+    file = f"{name}.{extension(fmt)}"
+    with metrics.stage("encode"):
+        write(file, encode(out, fmt))
+    logger.info(f"Image stored at /images/{file}")
+    link = f"![image]({url(file)})"
+    if out is not img:
+        link += preview_note(img.shape)
+    return link
+
+
+def settings():
+    """
+    Gets the encoder settings that change the output files
+    returns a dictionary
+    """
+    return {"format": extension(), "jpeg_quality": JPEG_QUALITY, "jpeg_progressive": JPEG_PROGRESSIVE, "webp_quality": WEBP_QUALITY,
+            "png_compression": PNG_COMPRESSION, "preview_pixels": PREVIEW_PIXELS}
@@ -0,0 +1,99 @@
+import os
+import asyncio
+import logging
+import functools
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+WORKERS = int(os.environ.get("TOOL_WORKERS", os.cpu_count() or 4)) # threads running tool bodies
+LIMITS = os.environ.get("TOOL_LIMITS", "") # per-tool concurrency limits, e.g. "segment=1,correct=4"
+
+
+def parse_limits(limits: str):
+    """
+    Parses per-tool concurrency limits
+    limits: comma separated name=limit pairs
+    returns a dictionary of tool name to limit
+    """
+    parsed = {}
+    for pair in limits.split(","):
+        if "=" in pair:
+            name, limit = pair.split("=", 1)
+            parsed[name.strip()] = int(limit)
+    return parsed
+
+
+class ToolExecutor:
+    """
+    Runs blocking tool bodies (file I/O, numpy, cv2) in a bounded thread pool so the event loop stays responsive.
+    numpy, cv2 and torch release the GIL, so the threads run on separate cores.
+    Each tool can be limited to a number of concurrent calls, calls over the limit wait in a queue.
+    """
+
+    def __init__(self, workers: int = WORKERS, limits: dict = None):
+        """
+        workers: the number of worker threads
+        limits: dictionary of tool name to maximum concurrent calls, tools not listed may use every worker
+        """
+        self.workers = workers
+        self.limits = parse_limits(LIMITS) if limits is None else limits
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="tool")
+        self._semaphores = {}
+        self._stats = {}
+
+    def _semaphore(self, name: str):
+        if name not in self._semaphores:
+            self._semaphores[name] = asyncio.Semaphore(self.limits.get(name, self.workers))
+        return self._semaphores[name]
+
+    async def run(self, name: str, fn, *args, **kwargs):
+        """
+        Runs a blocking function in the pool
+        name: the tool name used for concurrency limits and metrics
+        fn: the function to run
+        returns the result of the function
+        """
+        stats = self._stats.setdefault(name, {"queued": 0, "running": 0, "done": 0, "errors": 0})
+        stats["queued"] += 1
+        acquired = False
+        try:
+            async with self._semaphore(name):
+                acquired = True
+                stats["queued"] -= 1
+                stats["running"] += 1
+                try:
+                    context = contextvars.copy_context() # keep the metrics trace of the calling tool
+                    return await asyncio.get_running_loop().run_in_executor(self.pool, functools.partial(context.run, fn, *args, **kwargs))
+                except Exception:
+                    stats["errors"] += 1
+                    raise
+                finally:
+                    stats["running"] -= 1
+                    stats["done"] += 1
+        finally:
+            if not acquired: # cancelled while waiting
+                stats["queued"] -= 1
+
+    def tool(self, fn):
+        """
+        Decorator turning a blocking tool body into an async tool that runs in the pool, so image work never blocks
+        the event loop serving other calls
+        fn: the blocking function, named after the tool
+        returns an async function with the same signature
+        """
+        @functools.wraps(fn)
+        async def run(*args, **kwargs):
+            return await self.run(fn.__name__, fn, *args, **kwargs)
+        return run
+
+    def stats(self):
+        """
+        Gets the pool usage
+        returns a dictionary with the worker count and the queued, running, finished and failed calls of each tool
+        """
+        return {"workers": self.workers, "limits": self.limits, "tools": {name: dict(s) for name, s in self._stats.items()}}
+
+
+executor = ToolExecutor()
@@ -1,11 +1,19 @@
 import numpy as np
 import io
+import os
 import base64
 import logging
+import functools
+import math
+import threading
+import tempfile
 from PIL import Image
 from fastmcp.utilities.types import Image as Img
 from mcp.types import ImageContent
 import cv2
+from metrics import metrics
+
+TILE_BUDGET = int(os.environ.get("TILE_BYTES", 32 * 1024 * 1024)) # bytes of pixels processed at once
 
 def conv64toim(b64: str):
     """
@@ -27,6 +35,27 @@ def conv64toarray(b64: str):
     a = np.asarray(img)
     return a/255.0
 
+def load_array(path: str):
+    """
+    Load a stored image as a uint8 RGB numpy array
+    path: path to the stored image without its extension
+    returns a numpy array. Raw .npy files written by the filter are memory-mapped (zero-copy),
+    older base64 .txt files are decoded
+    """
+    if os.path.exists(path + ".npy"):
+        with metrics.stage("read"):
+            metrics.record(bytes=os.path.getsize(path + ".npy"))
+            return np.load(path + ".npy", mmap_mode="r")
+    with metrics.stage("read"):
+        with open(path + ".txt") as f:
+            b64 = f.read()
+        metrics.record(bytes=len(b64))
+    with metrics.stage("b64decode"):
+        image_bytes = base64.b64decode(b64)
+    with metrics.stage("decode"):
+        img = Image.open(io.BytesIO(image_bytes))
+        return np.asarray(img.convert("RGB"))
+
 def encode_image(image):
     """
     Convert a PIL image to a base64 strng
@@ -96,3 +125,246 @@ def rgb():
                     [-0.0004, -0.0041, 0.6935]]).T
 
 
+def correction(dp: float, dd: float):
+    """
+    Gets the matrix for colorblind color correction
+    dp: degree of protanopia colorblindness
+    dd: degree of deuteranopia colorblindness
+    returns: a 3x3 matrix
+    """
+    return np.array([[1 - dd/2, dd/2, 0],
+                     [dp/2, 1 - dd, 1-dp/2 * dd],
+                     [dp/4, dd/4, 1 - (dp + dd)/4]]).T
+
+@functools.lru_cache(maxsize=256)
+def simulation_matrix(color: str, degree: float):
+    """
+    Gets the fused matrix that simulates colorblindness directly on rgb pixels (rgb->lms, filter, lms->rgb)
+    color: the type of colorblindness
+    degree: degree of colorblindness
+    returns: a read-only 3x3 float32 matrix, or None if the type of colorblindness is unknown
+    """
+    match color:
+        case "protanopia":
+            m = lms() @ protanopia(degree) @ rgb()
+        case "deuteranopia":
+            m = lms() @ deuteranopia(degree) @ rgb()
+        case "tritanopia":
+            m = lms() @ tritanopia(degree) @ rgb()
+        case "achromatopsia":
+            m = achromatopsia().T # luminance, applied in rgb
+        case __:
+            return None
+    m = m.astype(np.float32)
+    m.setflags(write=False) # shared through the cache
+    return m
+
+@functools.lru_cache(maxsize=256)
+def correction_matrix(dp: float, dd: float):
+    """
+    Gets the cached color correction matrix
+    dp: degree of protanopia colorblindness
+    dd: degree of deuteranopia colorblindness
+    returns: a read-only 3x3 float32 matrix
+    """
+    m = correction(dp, dd).astype(np.float32)
+    m.setflags(write=False)
+    return m
+
+def output_array(shape: tuple):
+    """
+    Allocates a uint8 output image. Images larger than the tile budget are backed by an anonymous
+    temporary file so that they are paged to disk instead of held in memory
+    shape: the shape of the image
+    returns: a numpy array (or memmap)
+    """
+    if int(np.prod(shape)) <= TILE_BUDGET:
+        return np.empty(shape, np.uint8)
+    return np.memmap(tempfile.TemporaryFile(), dtype=np.uint8, mode="w+", shape=shape)
+
+def bands(height: int, row_bytes: int, budget: int = TILE_BUDGET):
+    """
+    Splits an image into row bands that fit in the tile budget
+    height: the number of rows in the image
+    row_bytes: the number of bytes processed per row
+    budget: the number of bytes processed per band
+    returns: a list of (start, stop) row ranges
+    """
+    step = max(1, budget // max(1, row_bytes))
+    return [(y, min(y + step, height)) for y in range(0, height, step)]
+
+def transform(a: np.ndarray, matrix: np.ndarray, bgr: bool = False, out: np.ndarray = None):
+    """
+    Applies a color matrix to every pixel of a uint8 image.
+    Runs band by band on the uint8 data with saturation, without a float copy of the image.
+    a: uint8 rgb image of shape (h, w, 3)
+    matrix: 3x3 matrix applied as pixels @ matrix
+    bgr: output the channels in bgr order (for cv2.imwrite) instead of rgb
+    out: (optional) contiguous uint8 array of the same shape to write into
+    returns: a uint8 image of shape (h, w, 3)
+    """
+    m = np.ascontiguousarray((matrix[:, ::-1] if bgr else matrix).T)
+    out = output_array(a.shape) if out is None else out
+    for y0, y1 in bands(a.shape[0], a.shape[1] * 3):
+        cv2.transform(np.ascontiguousarray(a[y0:y1]), m, dst=out[y0:y1])
+    return out
+
+def crop(a: np.ndarray, top: int, bottom: int, left: int, right: int, bgr: bool = False):
+    """
+    Crops a uint8 image band by band
+    a: uint8 rgb image of shape (h, w, 3)
+    top, bottom, left, right: the crop box (a[top:bottom, left:right])
+    bgr: output the channels in bgr order (for cv2.imwrite) instead of rgb
+    returns: a uint8 image
+    """
+    region = a[top:bottom, left:right]
+    out = output_array(region.shape)
+    for y0, y1 in bands(region.shape[0], region.shape[1] * 3):
+        band = np.ascontiguousarray(region[y0:y1])
+        out[y0:y1] = cv2.cvtColor(band, cv2.COLOR_RGB2BGR) if bgr else band
+    return out
+
+def resize(a: np.ndarray, size: tuple = (0, 0), fx: float = 1, fy: float = 1, bgr: bool = False):
+    """
+    Resizes a uint8 image with bilinear interpolation, band by band.
+    Downscales to an exact size run cv2.resize on bands aligned to whole source rows and match it exactly.
+    Other resizes sample with cv2.warpAffine, whose 1/32 pixel interpolation weights can differ from cv2.resize by a few levels
+    a: uint8 rgb image of shape (h, w, 3)
+    size: the size (x, y) to resize to. If size is (0, 0), the scale factors are used instead
+    fx, fy: the horizontal and vertical scale factors
+    bgr: output the channels in bgr order (for cv2.imwrite) instead of rgb
+    returns: a uint8 image
+    """
+    h, w = a.shape[:2]
+    if tuple(size) != (0, 0):
+        ow, oh = int(size[0]), int(size[1])
+        sx, sy = w / ow, h / oh # source pixels per output pixel
+        exact = True # the scale is the size ratio by construction
+    else:
+        ow, oh = int(round(w * fx)), int(round(h * fy))
+        sx, sy = 1 / fx, 1 / fy # same as cv2.resize
+        exact = round(w * fx) == w * fx and round(h * fy) == h * fy # the factors give whole output sizes
+    out = output_array((oh, ow, 3))
+    row_bytes = max(ow, int(w * sy)) * 3
+    period = oh // math.gcd(h, oh) # output rows starting on a whole source row
+    step = (max(1, TILE_BUDGET // row_bytes) // period) * period
+    if exact and oh <= h and step > 0:
+        # every output row of a downscale samples inside its own band, so each band resizes like the whole image
+        for y0 in range(0, oh, step):
+            y1 = min(y0 + step, oh)
+            band = cv2.resize(np.ascontiguousarray(a[y0 * h // oh:y1 * h // oh]), (ow, y1 - y0), interpolation=cv2.INTER_LINEAR)
+            out[y0:y1] = cv2.cvtColor(band, cv2.COLOR_RGB2BGR) if bgr else band
+        return out
+    for y0, y1 in bands(oh, row_bytes):
+        # source rows needed for this band, sampled like cv2.resize: src = (dst + 0.5) * scale - 0.5
+        s0 = max(0, int(np.floor((y0 + 0.5) * sy - 0.5)))
+        s1 = min(h, int(np.ceil((y1 - 0.5) * sy - 0.5)) + 2)
+        m = np.array([[sx, 0, 0.5 * sx - 0.5], [0, sy, (y0 + 0.5) * sy - 0.5 - s0]])
+        band = cv2.warpAffine(np.ascontiguousarray(a[s0:s1]), m, (ow, y1 - y0),
+                              flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP, borderMode=cv2.BORDER_REPLICATE)
+        out[y0:y1] = cv2.cvtColor(band, cv2.COLOR_RGB2BGR) if bgr else band
+    return out
+
+def contact_sheet(images, labels: list, shape: tuple, cols: int = 0):
+    """
+    Arranges equally sized images in a labelled grid
+    images: iterable of uint8 images, consumed one at a time
+    labels: the caption drawn on each image
+    shape: the shape (h, w, 3) of every image
+    cols: the number of columns, (default 0) for a square-ish grid
+    returns: a uint8 image
+    """
+    n = len(labels)
+    cols = cols or int(np.ceil(np.sqrt(n)))
+    rows = int(np.ceil(n / cols))
+    h, w = shape[:2]
+    sheet = output_array((rows * h, cols * w, 3))
+    sheet[:] = 255
+    scale = max(h, w) / 800 # keep captions readable on large images
+    for i, (img, label) in enumerate(zip(images, labels)):
+        y, x = (i // cols) * h, (i % cols) * w
+        sheet[y:y + h, x:x + w] = img
+        cv2.putText(sheet, label, (x + 10, y + int(30 * scale) + 10), cv2.FONT_HERSHEY_SIMPLEX, scale, (255, 255, 255), max(1, int(6 * scale)))
+        cv2.putText(sheet, label, (x + 10, y + int(30 * scale) + 10), cv2.FONT_HERSHEY_SIMPLEX, scale, (0, 0, 0), max(1, int(2 * scale)))
+    return sheet
+
+
+def letterbox(img: np.ndarray, shape: tuple):
+    """
+    Fits an image into a white cell of a fixed size, keeping the aspect ratio
+    img: uint8 image
+    shape: the shape (h, w, 3) of the cell
+    returns: a uint8 image of the cell shape
+    """
+    h, w = shape[:2]
+    cell = np.full((h, w, 3), 255, np.uint8)
+    s = min(h / img.shape[0], w / img.shape[1], 1) # only shrink
+    if s < 1:
+        img = cv2.resize(img, (max(1, int(img.shape[1] * s)), max(1, int(img.shape[0] * s))), interpolation=cv2.INTER_AREA)
+    cell[:img.shape[0], :img.shape[1]] = img
+    return cell
+
+
+def label_palette(labels: list):
+    """
+    Gets a fixed colour for each label, spread around the hue circle so neighbouring classes differ
+    labels: the label names in class order
+    returns: a dictionary of label -> bgr colour tuple
+    """
+    n = max(len(labels), 1)
+    step = next(k for k in range(n // 3 + 1, n + 1) if np.gcd(k, n) == 1) if n > 2 else 1 # visits every hue once, far apart
+    hues = np.array([(i * step % n) * 180 // n for i in range(len(labels))], np.uint8)
+    hsv = np.stack([hues, np.full_like(hues, 255), np.full_like(hues, 200)], -1)[None]
+    bgr = cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)[0]
+    return {label: tuple(int(c) for c in colour) for label, colour in zip(labels, bgr)}
+
+_overlays = threading.local()
+
+def overlay(a: np.ndarray, scale: float = 1):
+    """
+    Copies an image into a bgr drawing buffer, downscaled first so a preview only draws the pixels it keeps.
+    Buffers within the tile budget are reused by the next call on the same thread, so the result must be
+    encoded before drawing another overlay
+    a: uint8 rgb image of shape (h, w, 3)
+    scale: the downscale factor, at most 1
+    returns: a writable uint8 bgr image
+    """
+    h, w = a.shape[:2]
+    shape = (max(1, int(h * scale)), max(1, int(w * scale)), 3) if scale < 1 else (h, w, 3)
+    if int(np.prod(shape)) <= TILE_BUDGET:
+        out = getattr(_overlays, "buffer", None)
+        if out is None or out.shape != shape:
+            out = _overlays.buffer = np.empty(shape, np.uint8)
+    else:
+        out = output_array(shape)
+    if scale < 1:
+        cv2.resize(a, (shape[1], shape[0]), dst=out, interpolation=cv2.INTER_AREA)
+        cv2.cvtColor(out, cv2.COLOR_RGB2BGR, dst=out)
+        return out
+    for y0, y1 in bands(h, w * 3):
+        cv2.cvtColor(np.ascontiguousarray(a[y0:y1]), cv2.COLOR_RGB2BGR, dst=out[y0:y1])
+    return out
+
+def annotate(img: np.ndarray, boxes: list, palette: dict, scale: float = 1):
+    """
+    Draws segment boxes and captions onto an image in place, one polyline call per label
+    img: uint8 bgr image
+    boxes: the segments in the format of [(label, [score, [box]])...]
+    palette: label -> bgr colour, unknown labels are grey
+    scale: the factor from box coordinates to image pixels
+    returns: the image
+    """
+    if len(boxes) == 0:
+        return img
+    labels = np.array([b[0] for b in boxes])
+    corners = np.rint(np.array([b[1][1] for b in boxes], np.float64) * scale).astype(np.int32)
+    rects = np.stack([corners[:, [0, 2, 2, 0]], corners[:, [1, 1, 3, 3]]], -1) # (n, 4, 2) outlines
+    size = max(img.shape[:2]) / 1000 # keep lines and captions visible on large images
+    thickness = max(1, round(size))
+    for label in np.unique(labels):
+        cv2.polylines(img, list(rects[labels == label]), True, palette.get(label, (128, 128, 128)), thickness)
+    font = max(1.0, size)
+    for label, (score, _), (x0, y0, _, _) in zip(labels, (b[1] for b in boxes), corners):
+        cv2.putText(img, f"{label}: {score}", (int(x0), max(int(y0) - 2, int(12 * font))), cv2.FONT_HERSHEY_PLAIN, font,
+                    palette.get(label, (128, 128, 128)), max(1, round(2 * size)))
+    return img
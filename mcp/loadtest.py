@@ -0,0 +1,258 @@
+"""
+Load tests the image pipeline without Open WebUI, vLLM or a GPU.
+
+Each simulated chat sends a synthetic document page as an image_url item through the Open WebUI filter
+(filter.py, with open_webui.utils.misc stubbed), then replays the tool calls the model would make for it
+against the MCP server. Chats run at a fixed concurrency and the report has the latency percentiles of the
+filter, of each tool and of the whole chat, and the throughput.
+
+The server is reached in-process (local), by starting server.py over stdio like mcpo does (stdio), over MCP
+streamable HTTP (http) or through the mcpo OpenAPI proxy (mcpo). With http and mcpo the filter must write into the
+images folder of the server, pass it with --workdir.
+
+command to run: python loadtest.py --transport stdio --tiny-model --chats 50 --concurrency 8
+against the compose stack: python loadtest.py --transport mcpo --url http://localhost:8002 --workdir ..
+"""
+import os
+import sys
+import ast
+import json
+import time
+import types
+import base64
+import asyncio
+import logging
+import argparse
+import tempfile
+import contextlib
+import importlib.util
+from pathlib import Path
+import numpy as np
+import cv2
+
+logger = logging.getLogger(__name__)
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = ["segment", "visualize_segmentaton", "crop", "correct"]
+
+
+def get_last_user_message_item(messages: list):
+    for message in reversed(messages):
+        if message.get("role") == "user":
+            return message
+    return None
+
+
+def load_filter(path: str, images: str):
+    """
+    Loads the Open WebUI filter, stubbing open_webui.utils.misc if Open WebUI is not installed
+    path: the path of filter.py
+    images: the images folder the filter writes to
+    returns a Filter instance
+    """
+    try:
+        import open_webui.utils.misc # noqa: F401
+    except ImportError:
+        for name in ("open_webui", "open_webui.utils", "open_webui.utils.misc"):
+            sys.modules.setdefault(name, types.ModuleType(name))
+        sys.modules["open_webui.utils.misc"].get_last_user_message_item = get_last_user_message_item
+    spec = importlib.util.spec_from_file_location("filter", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.IMAGE_DIR = images
+    module.logger.setLevel(logging.WARNING) # the filter logs every step at debug level
+    return module.Filter()
+
+
+def chat_body(img: np.ndarray, chat: str):
+    """
+    Builds the body Open WebUI sends to the filter for a message with an attached image
+    img: uint8 rgb image
+    chat: the chat id
+    returns a dictionary
+    """
+    ok, buf = cv2.imencode(".png", cv2.cvtColor(img, cv2.COLOR_RGB2BGR))
+    url = "data:image/png;base64," + base64.b64encode(buf.tobytes()).decode()
+    content = [{"type": "text", "text": "Segment this page and show me the layout. "},
+               {"type": "image_url", "image_url": {"url": url}}]
+    return {"chat_id": chat, "messages": [{"role": "user", "content": content}]}
+
+
+def image_files(body):
+    """
+    Gets the image file names the filter added to the last message
+    body: the body returned by the filter
+    returns a list of file names
+    """
+    if not isinstance(body, dict): # the filter returns a message on errors
+        raise ValueError(f"filter error: {body}")
+    text = body["messages"][-1]["content"][-1]["text"]
+    return ast.literal_eval(text[text.index("The image files are: ") + len("The image files are: "):])
+
+
+@contextlib.asynccontextmanager
+async def connect(args, workdir: str):
+    """
+    Connects to the MCP server
+    args: the command line arguments
+    workdir: the folder holding images/ and cache/ of the server
+    yields an async function calling a tool with a dictionary of arguments and returning the result text
+    """
+    if args.transport == "mcpo":
+        import requests
+
+        async def call(tool: str, arguments: dict):
+            r = await asyncio.to_thread(requests.post, f"{args.url.rstrip('/')}/{tool}", json=arguments, timeout=args.timeout)
+            r.raise_for_status()
+            return r.text
+        yield call
+        return
+
+    from fastmcp import Client, FastMCP
+    from fastmcp.client.transports import PythonStdioTransport
+    if args.transport == "local":
+        import tools
+        target = FastMCP("loadtest")
+        await tools.initialize_tools(target)
+    elif args.transport == "stdio":
+        target = PythonStdioTransport(args.server, cwd=workdir, env=dict(os.environ),
+                                      log_file=Path(workdir, "server.log")) # the server logs at debug level
+    else:
+        target = args.url
+    async with Client(target, timeout=args.timeout) as client:
+        async def call(tool: str, arguments: dict):
+            result = await client.call_tool(tool, arguments, raise_on_error=False)
+            return " ".join(getattr(c, "text", "") for c in result.content)
+        yield call
+
+
+class Recorder:
+    """
+    Collects the latency of each step of the simulated chats
+    """
+
+    def __init__(self):
+        self.latencies = {} # step -> seconds
+        self.errors = {} # step -> count
+        self.calls = 0
+
+    def add(self, step: str, seconds: float, error: bool = False):
+        self.latencies.setdefault(step, []).append(seconds)
+        self.errors[step] = self.errors.get(step, 0) + int(error)
+
+    def report(self, elapsed: float, chats: int):
+        """
+        Gets the latency percentiles of each step and the throughput
+        elapsed: the wall time of the run
+        chats: the number of chats that were run
+        returns a dictionary
+        """
+        steps = {}
+        for step, values in self.latencies.items():
+            ms = np.array(values) * 1000
+            steps[step] = {"count": len(values), "errors": self.errors[step], "p50_ms": round(float(np.percentile(ms, 50)), 3),
+                           "p90_ms": round(float(np.percentile(ms, 90)), 3), "p99_ms": round(float(np.percentile(ms, 99)), 3),
+                           "max_ms": round(float(ms.max()), 3), "mean_ms": round(float(ms.mean()), 3)}
+        return {"seconds": round(elapsed, 3), "chats": chats, "chats_per_s": round(chats / elapsed, 3),
+                "tool_calls_per_s": round(self.calls / elapsed, 3), "steps": steps}
+
+
+async def chat(i: int, args, flt, call, pages: list, recorder: Recorder):
+    """
+    Runs one simulated chat: the filter stores the uploaded image, then the scripted tool calls run on it in order
+    i: the chat number
+    """
+    img = pages[i % len(pages)]
+    body = chat_body(img, f"loadtest-{args.run}-{i}")
+    start = time.perf_counter()
+    failed = False
+    try:
+        file = image_files(await flt.inlet(body, None, __user__={"id": f"loadtest{i}"}, __metadata__={"chat_id": body["chat_id"]}))[0]
+        recorder.add("filter", time.perf_counter() - start)
+    except Exception as e:
+        logger.info(f"chat {i} filter error: {e}")
+        recorder.add("filter", time.perf_counter() - start, True)
+        recorder.add("chat", time.perf_counter() - start, True)
+        return
+    from benchmark import tool_args
+    for tool in args.script:
+        t = time.perf_counter()
+        try:
+            text = await call(tool, tool_args(tool, file, img.shape))
+            error = "error" in text.lower()
+        except Exception as e:
+            text, error = str(e), True
+        recorder.add(tool, time.perf_counter() - t, error)
+        recorder.calls += 1
+        if error:
+            logger.info(f"chat {i} {tool}: {text[:200]}")
+        failed |= error
+    recorder.add("chat", time.perf_counter() - start, failed)
+
+
+async def run(args, workdir: str):
+    from benchmark import synthetic_page
+    images = os.path.join(workdir, "images")
+    os.makedirs(images, exist_ok=True)
+    flt = load_filter(args.filter, images)
+    distinct = args.distinct or args.chats
+    pages = [synthetic_page(args.size, seed=s)[0] for s in range(distinct)]
+    async with connect(args, workdir) as call:
+        for i in range(args.warmup): # loads the model, not timed
+            await chat(-1 - i, args, flt, call, pages, Recorder())
+        recorder = Recorder()
+        limit = asyncio.Semaphore(args.concurrency)
+
+        async def limited(i):
+            async with limit:
+                await chat(i, args, flt, call, pages, recorder)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[limited(i) for i in range(args.chats)])
+        return recorder.report(time.perf_counter() - start, args.chats)
+
+
+def main():
+    from benchmark import TOOLS
+    parser = argparse.ArgumentParser(description="Load test the filter and MCP tools with simulated chats")
+    parser.add_argument("--transport", choices=["local", "stdio", "http", "mcpo"], default="local", help="how to reach the MCP server")
+    parser.add_argument("--url", default="http://localhost:8002", help="server url for http (the /mcp endpoint) and mcpo")
+    parser.add_argument("--chats", type=int, default=20, help="number of simulated chats")
+    parser.add_argument("--concurrency", type=int, default=4, help="chats running at once")
+    parser.add_argument("--script", nargs="+", default=SCRIPT, choices=TOOLS, help="tools called in order in each chat")
+    parser.add_argument("--size", type=int, default=1024, help="width of the synthetic pages in pixels")
+    parser.add_argument("--distinct", type=int, default=0, help="number of distinct pages, repeated pages hit the caches (default one per chat)")
+    parser.add_argument("--warmup", type=int, default=1, help="untimed chats run first")
+    parser.add_argument("--timeout", type=float, default=300, help="seconds before a tool call fails")
+    parser.add_argument("--tiny-model", action="store_true", help="use a small randomly initialised RT-DETR model (offline, local and stdio)")
+    parser.add_argument("--server", default=os.path.join(HERE, "server.py"), help="the server script started by the stdio transport")
+    parser.add_argument("--filter", default=os.path.join(HERE, "..", "filter.py"), help="path of the Open WebUI filter")
+    parser.add_argument("--workdir", help="folder holding the server's images/ and cache/ (default a temporary folder)")
+    parser.add_argument("--output", help="write the report as JSON to this file")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    args.run = int(time.time())
+    args.filter = os.path.abspath(args.filter)
+    args.server = os.path.abspath(args.server)
+    output = os.path.abspath(args.output) if args.output else None
+
+    sys.path.insert(0, HERE)
+    with contextlib.ExitStack() as stack:
+        workdir = os.path.abspath(args.workdir) if args.workdir else stack.enter_context(tempfile.TemporaryDirectory())
+        if args.tiny_model:
+            from benchmark import tiny_model
+            os.environ["SEGMENT_MODEL"] = tiny_model(os.path.join(workdir, "tiny-rtdetr"))
+        os.chdir(workdir) # the local server reads and writes images/ and cache/ relative to the working directory
+        report = asyncio.run(run(args, workdir))
+
+    report.update({"transport": args.transport, "concurrency": args.concurrency, "script": args.script, "size": args.size, "cpus": os.cpu_count()})
+    for step, r in report["steps"].items():
+        print(f"{step:24s} n {r['count']:5d}  p50 {r['p50_ms']:10.2f} ms  p90 {r['p90_ms']:10.2f} ms  p99 {r['p99_ms']:10.2f} ms  errors {r['errors']}")
+    print(f"{report['chats_per_s']:.2f} chats/s  {report['tool_calls_per_s']:.2f} tool calls/s  over {report['seconds']:.1f} s")
+    if output:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+import os
+import time
+import logging
+import inspect
+import functools
+import threading
+import contextvars
+from contextlib import contextmanager
+from storage import write_atomic
+
+logger = logging.getLogger(__name__)
+
+METRICS_PATH = os.environ.get("METRICS_PATH", "cache/metrics.prom") # prometheus text dump
+METRICS_INTERVAL = float(os.environ.get("METRICS_INTERVAL", 5)) # seconds between dumps
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30] # latency histogram buckets in seconds
+
+_current = contextvars.ContextVar("trace", default=None)
+
+
+class Trace:
+    """
+    Timings and sizes recorded during one tool call
+    """
+
+    def __init__(self, tool: str):
+        self.tool = tool
+        self.stages = {} # stage -> seconds
+        self.bytes = 0
+        self.pixels = 0
+        self.shape = None
+        self.error = None
+
+
+class Metrics:
+    """
+    Collects per-tool call counts, errors, latency, per-stage time (read, b64decode, decode, compute, inference, encode),
+    bytes and pixels processed. Exposed as a dictionary for the stats tool and as a prometheus text dump.
+    """
+
+    def __init__(self, path: str = METRICS_PATH, interval: float = METRICS_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.tools = {}
+        self._lock = threading.Lock()
+        self._dumped = 0
+
+    def trace(self, fn):
+        """
+        Decorator recording every call of a tool with its latency, errors and the time spent in each metrics.stage(),
+        reported by the stats tool. Works on both blocking and async tools
+        fn: the tool function
+        returns the wrapped function with the same signature
+        """
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def run(*args, **kwargs):
+                trace, token, start = self._begin(fn.__name__)
+                try:
+                    return await fn(*args, **kwargs)
+                except Exception as e:
+                    trace.error = e
+                    raise
+                finally:
+                    self._end(trace, token, start)
+        else:
+            @functools.wraps(fn)
+            def run(*args, **kwargs):
+                trace, token, start = self._begin(fn.__name__)
+                try:
+                    return fn(*args, **kwargs)
+                except Exception as e:
+                    trace.error = e
+                    raise
+                finally:
+                    self._end(trace, token, start)
+        return run
+
+    def _begin(self, tool: str):
+        trace = Trace(tool)
+        return trace, _current.set(trace), time.perf_counter()
+
+    def _end(self, trace: Trace, token, start: float):
+        _current.reset(token)
+        self._add(trace, time.perf_counter() - start)
+        if time.time() - self._dumped > self.interval:
+            self.dump()
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Times a stage of the current tool call. Does nothing outside of a tool call
+        name: the stage name
+        """
+        trace = _current.get()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if trace is not None:
+                trace.stages[name] = trace.stages.get(name, 0) + time.perf_counter() - start
+
+    def record(self, bytes: int = 0, shape: tuple = None):
+        """
+        Records the data processed by the current tool call
+        bytes: the number of bytes read
+        shape: the shape of an image processed
+        """
+        trace = _current.get()
+        if trace is None:
+            return
+        trace.bytes += bytes
+        if shape is not None:
+            trace.shape = tuple(shape)
+            trace.pixels += shape[0] * shape[1]
+
+    def error(self, e: Exception):
+        """
+        Marks the current tool call as failed, for tools that return their errors as text
+        e: the exception
+        """
+        trace = _current.get()
+        if trace is not None:
+            trace.error = e
+
+    def _add(self, trace: Trace, seconds: float):
+        with self._lock:
+            t = self.tools.setdefault(trace.tool, {"calls": 0, "errors": 0, "seconds": 0.0, "stages": {}, "bytes": 0,
+                                                   "pixels": 0, "shape": None, "buckets": [0] * len(BUCKETS)})
+            t["calls"] += 1
+            t["errors"] += trace.error is not None
+            t["seconds"] += seconds
+            t["bytes"] += trace.bytes
+            t["pixels"] += trace.pixels
+            t["shape"] = trace.shape or t["shape"]
+            for stage, s in trace.stages.items():
+                t["stages"][stage] = t["stages"].get(stage, 0) + s
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    t["buckets"][i] += 1
+
+    def summary(self):
+        """
+        Gets the collected metrics
+        returns a dictionary of tool name to calls, errors, mean latency and mean time per stage in ms, bytes and pixels processed
+        and the last image shape
+        """
+        with self._lock:
+            return {tool: {"calls": t["calls"], "errors": t["errors"],
+                           "mean_ms": round(t["seconds"] / t["calls"] * 1000, 2),
+                           "stages_mean_ms": {s: round(v / t["calls"] * 1000, 2) for s, v in t["stages"].items()},
+                           "bytes": t["bytes"], "pixels": t["pixels"], "last_shape": t["shape"]}
+                    for tool, t in self.tools.items()}
+
+    def prometheus(self):
+        """
+        Formats the collected metrics in the prometheus text format
+        returns a string
+        """
+        lines = []
+        def metric(name, kind, help, samples):
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                labels = ",".join(f'{k}="{v}"' for k, v in labels.items())
+                lines.append(f"{name}{{{labels}}} {value}")
+        with self._lock:
+            tools = sorted(self.tools.items())
+            metric("mcp_tool_calls_total", "counter", "Tool calls", [({"tool": n}, t["calls"]) for n, t in tools])
+            metric("mcp_tool_errors_total", "counter", "Tool calls that failed", [({"tool": n}, t["errors"]) for n, t in tools])
+            metric("mcp_tool_bytes_total", "counter", "Bytes of image files read", [({"tool": n}, t["bytes"]) for n, t in tools])
+            metric("mcp_tool_pixels_total", "counter", "Image pixels processed", [({"tool": n}, t["pixels"]) for n, t in tools])
+            metric("mcp_tool_stage_seconds_total", "counter", "Time spent in each stage of a tool call",
+                   [({"tool": n, "stage": s}, round(v, 6)) for n, t in tools for s, v in sorted(t["stages"].items())])
+            lines.append("# HELP mcp_tool_latency_seconds Tool call latency")
+            lines.append("# TYPE mcp_tool_latency_seconds histogram")
+            for n, t in tools:
+                for bound, count in zip(BUCKETS, t["buckets"]):
+                    lines.append(f'mcp_tool_latency_seconds_bucket{{tool="{n}",le="{bound}"}} {count}')
+                lines.append(f'mcp_tool_latency_seconds_bucket{{tool="{n}",le="+Inf"}} {t["calls"]}')
+                lines.append(f'mcp_tool_latency_seconds_sum{{tool="{n}"}} {round(t["seconds"], 6)}')
+                lines.append(f'mcp_tool_latency_seconds_count{{tool="{n}"}} {t["calls"]}')
+        return "\n".join(lines) + "\n"
+
+    def dump(self):
+        """
+        Writes the prometheus text dump to the metrics path
+        """
+        self._dumped = time.time()
+        try:
+            text = self.prometheus()
+            write_atomic(self.path, lambda f: f.write(text), "w") # scrapers never see a partial file
+        except OSError as e:
+            logger.info(f"metrics dump error: {e}")
+
+
+metrics = Metrics()
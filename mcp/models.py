@@ -0,0 +1,79 @@
+import time
+import logging
+import threading
+import backends
+
+logger = logging.getLogger(__name__)
+
+
+class ModelManager:
+    """
+    Loads the layout model in a background thread so the server can register and answer tools immediately.
+    torch and transformers are only imported by the loading thread.
+    """
+
+    def __init__(self, name: str, backend: str = backends.BACKEND):
+        """
+        name: the huggingface model name
+        backend: the inference backend, torch, torch-int8, onnx or onnx-int8
+        """
+        self.name = name
+        self.backend = backend
+        self.state = "not started"
+        self.error = None
+        self.load_time = None
+        self.processor = None
+        self.model = None
+        self._ready = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        """
+        Starts loading the model in the background. Does nothing if it is loading or loaded, retries if loading failed
+        """
+        with self._lock:
+            if self.state in ("loading", "ready"):
+                return
+            self.state = "loading"
+            self.error = None
+            self._ready.clear()
+            self._thread = threading.Thread(target=self._load, name="model-loader", daemon=True)
+            self._thread.start()
+
+    def _load(self):
+        start = time.time()
+        logger.info(f"loading {self.name} with the {self.backend} backend")
+        try:
+            from transformers import RTDetrV2ForObjectDetection, RTDetrImageProcessor
+            self.processor = RTDetrImageProcessor.from_pretrained(self.name)
+            self.model = backends.load_backend(self.name, lambda: RTDetrV2ForObjectDetection.from_pretrained(self.name).eval(), self.backend)
+            self.state = "ready"
+        except Exception as e:
+            logger.info(f"model load error: {e}")
+            self.error = str(e)
+            self.state = "failed"
+        finally:
+            self.load_time = round(time.time() - start, 2)
+            logger.info(f"{self.name} {self.state} after {self.load_time}s")
+            self._ready.set()
+
+    def get(self, timeout: float = None):
+        """
+        Waits for the model to finish loading
+        timeout: the maximum number of seconds to wait
+        returns the (image processor, backend) pair, the backend takes pixel values and returns logits and pred_boxes
+        """
+        self.start()
+        if not self._ready.wait(timeout):
+            raise TimeoutError(f"{self.name} is still loading")
+        if self.state != "ready":
+            raise RuntimeError(f"{self.name} failed to load: {self.error}")
+        return self.processor, self.model
+
+    def status(self):
+        """
+        Gets the loading status of the model
+        returns a dictionary with the model name, backend, state, load time in seconds and error
+        """
+        return {"model": self.name, "backend": self.backend, "state": self.state, "load_time": self.load_time, "error": self.error}
@@ -0,0 +1,123 @@
+import os
+import glob
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+CACHE_PATH = os.environ.get("OUTPUT_CACHE_PATH", "cache/outputs.db")
+CACHE_BUDGET = int(os.environ.get("OUTPUT_CACHE_BYTES", 512 * 1024 * 1024)) # bytes of output images kept on disk
+IMAGE_DIR = "images"
+
+
+def output_key(file: str, digest: str, operation: str, params: dict):
+    """
+    Gets the cache key of a tool output. Outputs are stored next to their source image and removed with it,
+    so the same content under another file name gets its own output
+    file: the input image file name
+    digest: hash of the input image content
+    operation: the tool name
+    params: the arguments changing the output, including the encoder settings
+    returns a hex string
+    """
+    return hashlib.sha256(f"{file}|{digest}|{operation}|{json.dumps(params, sort_keys=True)}".encode()).hexdigest()
+
+
+class OutputCache:
+    """
+    Memoizes the outputs of deterministic image tools. The output files live in the images folder and are tracked in SQLite,
+    least recently used outputs are deleted once they exceed the byte budget.
+    """
+
+    def __init__(self, path: str = CACHE_PATH, budget: int = CACHE_BUDGET, directory: str = IMAGE_DIR):
+        self.path = path
+        self.budget = budget
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with self._connect() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS outputs (key TEXT PRIMARY KEY, name TEXT, link TEXT, size INTEGER, used REAL)")
+            db.execute("CREATE INDEX IF NOT EXISTS outputs_used ON outputs (used)")
+
+    @contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=10)
+        try:
+            with db: # commits on success
+                yield db
+        finally:
+            db.close()
+
+    def _files(self, name: str):
+        return glob.glob(os.path.join(glob.escape(self.directory), glob.escape(name) + "*"))
+
+    def _remove(self, name: str):
+        for f in self._files(name):
+            try:
+                os.remove(f)
+            except OSError: # already removed
+                pass
+
+    def get(self, key: str):
+        """
+        Looks up a tool output
+        key: the cache key from output_key()
+        returns the markdown link of the output or None if it is not stored or its files were removed
+        """
+        with self._lock, self._connect() as db:
+            row = db.execute("SELECT name, link FROM outputs WHERE key = ?", (key,)).fetchone()
+            if row is not None and len(self._files(row[0])) == 0: # deleted outside of the cache
+                db.execute("DELETE FROM outputs WHERE key = ?", (key,))
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            db.execute("UPDATE outputs SET used = ? WHERE key = ?", (time.time(), key))
+        return row[1]
+
+    def put(self, key: str, name: str, link: str):
+        """
+        Stores a tool output
+        key: the cache key from output_key()
+        name: the output file name without the extension, every file in the images folder starting with it belongs to the output
+        link: the markdown link returned by the tool
+        """
+        size = sum(os.path.getsize(f) for f in self._files(name))
+        with self._lock, self._connect() as db:
+            db.execute("INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?, ?)", (key, name, link, size, time.time()))
+            total = db.execute("SELECT COALESCE(SUM(size), 0) FROM outputs").fetchone()[0]
+            while total > self.budget: # evict least recently used
+                row = db.execute("SELECT key, name, size FROM outputs ORDER BY used LIMIT 1").fetchone()
+                if row is None or row[0] == key:
+                    break
+                self._remove(row[1])
+                db.execute("DELETE FROM outputs WHERE key = ?", (row[0],))
+                total -= row[2]
+                logger.info(f"evicted {row[1]} from output cache")
+
+    def clear(self):
+        """
+        Removes every stored output and its files
+        """
+        with self._lock, self._connect() as db:
+            for name, in db.execute("SELECT name FROM outputs").fetchall():
+                self._remove(name)
+            db.execute("DELETE FROM outputs")
+
+    def stats(self):
+        """
+        Gets cache usage
+        returns a dictionary of cache statistics
+        """
+        with self._lock, self._connect() as db:
+            entries, size = db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM outputs").fetchone()
+        return {"entries": entries, "bytes": size, "budget": self.budget, "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,110 @@
+"""
+Checks that an inference backend finds the same segments as the eager PyTorch model.
+
+Runs both backends on images from the images/ folder and on synthetic document pages at every input size of the
+resolution policy, matches the detections of each image by label and box overlap, and reports mismatches and latency.
+Exits with status 1 on a mismatch.
+
+command to run: python parity.py --backend onnx-int8 --images image0 --synthetic 3
+"""
+import os
+import sys
+import time
+import logging
+import argparse
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+
+def iou(a: list, b: list):
+    """
+    Gets the intersection over union of two boxes
+    a, b: boxes as [x0, y0, x1, y1]
+    returns a float between 0 and 1
+    """
+    w = max(0, min(a[2], b[2]) - max(a[0], b[0]))
+    h = max(0, min(a[3], b[3]) - max(a[1], b[1]))
+    inter = w * h
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union > 0 else 1.0
+
+
+def compare(reference: list, candidate: list, min_iou: float, score_tolerance: float):
+    """
+    Matches the segments found by two backends on one image. Detections are matched greedily by label and box overlap,
+    so the order of the detections does not matter
+    reference: the segments of the eager model in the format of [(label, [score, [box]])...]
+    candidate: the segments of the backend being checked
+    min_iou: the minimum overlap of matching boxes
+    score_tolerance: the maximum score difference of matching boxes
+    returns a list of mismatch messages
+    """
+    unmatched = list(candidate)
+    mismatches = []
+    for label, (score, box) in sorted(reference, key=lambda v: -v[1][0]):
+        best, best_iou = None, min_iou
+        for i, (l, (s, b)) in enumerate(unmatched):
+            overlap = iou(box, b)
+            if l == label and overlap >= best_iou and abs(s - score) <= score_tolerance:
+                best, best_iou = i, overlap
+        if best is None:
+            mismatches.append(f"missing {label} {score} {box}")
+        else:
+            unmatched.pop(best)
+    mismatches += [f"extra {l} {s} {b}" for l, (s, b) in unmatched]
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check an inference backend against the eager PyTorch model")
+    parser.add_argument("--backend", default="onnx", help="the backend to check: torch-int8, onnx or onnx-int8")
+    parser.add_argument("--model", help="the model name or path (default the server's model)")
+    parser.add_argument("--images", nargs="*", default=[], help="image files in the images folder")
+    parser.add_argument("--synthetic", type=int, default=2, help="number of synthetic pages at full size and at each input size")
+    parser.add_argument("--threshold", type=float, help="score threshold (default the server's threshold)")
+    parser.add_argument("--iou", type=float, default=0.9, help="minimum overlap of matching boxes")
+    parser.add_argument("--score-tolerance", type=float, default=0.05, help="maximum score difference of matching boxes")
+    parser.add_argument("--max-mismatch", type=float, default=0.0, help="allowed fraction of mismatched segments")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import tools
+    from store import store
+    from models import ModelManager
+    from benchmark import synthetic_page
+    if args.threshold is not None:
+        tools.threshold = args.threshold
+    name = args.model or tools.model_name
+    reference, candidate = ModelManager(name, "torch"), ModelManager(name, args.backend)
+    reference.start()
+    candidate.start()
+
+    tools.policy.budget = 0 # every input size is checked, whatever the measured latency
+    pages = [(file, store.pil(file)) for file in args.images]
+    for i in range(args.synthetic):
+        pages.append((f"synthetic{i}", Image.fromarray(synthetic_page(1024, seed=i)[0])))
+        for size in tools.policy.sizes: # pages small enough to be run at each input size, the page height is 1.3x its width
+            pages.append((f"synthetic{i}_{size}", Image.fromarray(synthetic_page(int(size / 1.3), seed=i)[0])))
+    failed = False
+    for file, img in pages:
+        times = []
+        outputs = []
+        for manager in (reference, candidate):
+            manager.get() # exclude loading and exporting from the latency
+            start = time.perf_counter()
+            outputs.append(tools.detect([img], manager)[0])
+            times.append(time.perf_counter() - start)
+        mismatches = compare(outputs[0], outputs[1], args.iou, args.score_tolerance)
+        fraction = len(mismatches) / max(len(outputs[0]) + len(outputs[1]), 1)
+        failed |= fraction > args.max_mismatch
+        print(f"{file:16s} input {tools.policy.size(*img.size):4d}  segments {len(outputs[0]):4d} / {len(outputs[1]):4d}  mismatched {fraction:6.1%}  "
+              f"torch {times[0] * 1000:9.1f} ms  {args.backend} {times[1] * 1000:9.1f} ms")
+        for m in mismatches[:10]:
+            print(f"    {m}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+import os
+import logging
+import threading
+import numpy as np
+import cv2
+import image as im
+
+logger = logging.getLogger(__name__)
+
+SIZES = [int(s) for s in os.environ.get("SEGMENT_SIZES", "320,480,640").split(",")] # square input sizes, the model is trained at 640
+LATENCY_BUDGET = float(os.environ.get("SEGMENT_LATENCY_BUDGET", 0)) # target seconds of inference per image, 0 to only adapt to the image size
+BLANK_DELTA = int(os.environ.get("SEGMENT_BLANK_DELTA", 16)) # grey levels from the background that count as content
+BLANK_PIXELS = int(os.environ.get("SEGMENT_BLANK_PIXELS", 16)) # images with fewer content pixels than this are not segmented
+
+
+class ResolutionPolicy:
+    """
+    Picks the input size of the layout model for each image. Small images are not upscaled to the full model size,
+    and with a latency budget large images are processed at the largest size expected to finish within the budget.
+    The cost per input pixel is measured from the batches that were run.
+    """
+
+    def __init__(self, sizes: list = SIZES, budget: float = LATENCY_BUDGET):
+        """
+        sizes: the allowed square input sizes
+        budget: target seconds of inference per image, 0 for no budget
+        """
+        self.sizes = sorted(sizes)
+        self.budget = budget
+        self.cost = None # seconds per input pixel, moving average
+        self._lock = threading.Lock()
+
+    def size(self, width: int, height: int):
+        """
+        Picks the input size for an image
+        width, height: the image dimensions
+        returns the side of the square input in pixels
+        """
+        longest = max(width, height)
+        fits = [s for s in self.sizes if s >= longest]
+        i = self.sizes.index(fits[0]) if fits else len(self.sizes) - 1 # smallest size that does not upscale
+        if self.budget > 0 and self.cost is not None:
+            while i > 0 and self.cost * self.sizes[i] ** 2 > self.budget:
+                i -= 1
+        return self.sizes[i]
+
+    def observe(self, size: int, count: int, seconds: float):
+        """
+        Records the time of a batch
+        size: the input size of the batch
+        count: the number of images in the batch
+        seconds: the inference time
+        """
+        cost = seconds / (count * size * size)
+        with self._lock:
+            self.cost = cost if self.cost is None else 0.8 * self.cost + 0.2 * cost
+
+    def stats(self):
+        """
+        Gets the policy state
+        returns a dictionary with the sizes, the latency budget and the estimated seconds per image at each size
+        """
+        estimate = {s: round(self.cost * s * s, 4) for s in self.sizes} if self.cost is not None else None
+        return {"sizes": self.sizes, "budget": self.budget, "estimate": estimate}
+
+
+def is_blank(img: np.ndarray, delta: int = BLANK_DELTA, pixels: int = BLANK_PIXELS):
+    """
+    Checks if an image is uniform, such as an empty page or a solid colour. The background is estimated on a small
+    thumbnail, but content is counted at full resolution band by band so thin strokes and small text are never lost
+    img: uint8 rgb image
+    delta: grey levels from the background that count as content
+    pixels: the minimum number of content pixels of a non-blank image
+    returns True if the image has no content to segment
+    """
+    h, w = img.shape[:2]
+    s = min(256 / max(h, w), 1)
+    thumb = cv2.resize(img, (max(1, int(w * s)), max(1, int(h * s))), interpolation=cv2.INTER_AREA) if s < 1 else img
+    background = int(np.median(cv2.cvtColor(np.ascontiguousarray(thumb), cv2.COLOR_RGB2GRAY)))
+    found = 0
+    for y0, y1 in im.bands(h, w * 3):
+        grey = cv2.cvtColor(np.ascontiguousarray(img[y0:y1]), cv2.COLOR_RGB2GRAY)
+        found += cv2.countNonZero(cv2.threshold(cv2.absdiff(grey, background), delta, 255, cv2.THRESH_BINARY)[1])
+        if found >= pixels: # stop at the first content
+            return False
+    return True
@@ -0,0 +1,98 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+CACHE_PATH = os.environ.get("SEGMENT_CACHE_PATH", "cache/segments.db")
+CACHE_BUDGET = int(os.environ.get("SEGMENT_CACHE_BYTES", 64 * 1024 * 1024)) # bytes of stored results
+
+
+def segment_key(digest: str, model: str, threshold: float, options: dict = {}):
+    """
+    Gets the cache key of a segmentation result
+    digest: hash of the image content
+    model: the segmentation model name
+    threshold: the score threshold used
+    options: other settings changing the result, such as the inference backend and the input sizes
+    returns a hex string
+    """
+    return hashlib.sha256(f"{digest}|{model}|{threshold}|{json.dumps(options, sort_keys=True)}".encode()).hexdigest()
+
+
+class SegmentCache:
+    """
+    Persistent content-addressed cache of segmentation results stored in SQLite.
+    Least recently used results are evicted once the stored results exceed the byte budget.
+    """
+
+    def __init__(self, path: str = CACHE_PATH, budget: int = CACHE_BUDGET):
+        self.path = path
+        self.budget = budget
+        self._lock = threading.Lock()
+        if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with self._connect() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS segments (key TEXT PRIMARY KEY, boxes TEXT, size INTEGER, used REAL)")
+            db.execute("CREATE INDEX IF NOT EXISTS segments_used ON segments (used)")
+
+    @contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=10)
+        try:
+            with db: # commits on success
+                yield db
+        finally:
+            db.close()
+
+    def get(self, key: str):
+        """
+        Looks up a segmentation result
+        key: the cache key from segment_key()
+        returns the segments in the format of [(label, [score, [box]])...] or None if not cached
+        """
+        with self._lock, self._connect() as db:
+            row = db.execute("SELECT boxes FROM segments WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE segments SET used = ? WHERE key = ?", (time.time(), key))
+        return json.loads(row[0])
+
+    def put(self, key: str, boxes: list):
+        """
+        Stores a segmentation result
+        key: the cache key from segment_key()
+        boxes: the segments in the format of [(label, [score, [box]])...]
+        """
+        data = json.dumps(boxes)
+        with self._lock, self._connect() as db:
+            db.execute("INSERT OR REPLACE INTO segments VALUES (?, ?, ?, ?)", (key, data, len(data), time.time()))
+            total = db.execute("SELECT COALESCE(SUM(size), 0) FROM segments").fetchone()[0]
+            while total > self.budget: # evict least recently used
+                row = db.execute("SELECT key, size FROM segments ORDER BY used LIMIT 1").fetchone()
+                if row is None or row[0] == key:
+                    break
+                db.execute("DELETE FROM segments WHERE key = ?", (row[0],))
+                total -= row[1]
+                logger.info(f"evicted {row[0]} from segment cache")
+
+    def clear(self):
+        """
+        Removes every stored result
+        """
+        with self._lock, self._connect() as db:
+            db.execute("DELETE FROM segments")
+
+    def stats(self):
+        """
+        Gets cache usage
+        returns a dictionary of cache statistics
+        """
+        with self._lock, self._connect() as db:
+            entries, size = db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM segments").fetchone()
+        return {"entries": entries, "bytes": size, "budget": self.budget}
@@ -0,0 +1,115 @@
+import threading
+from collections import OrderedDict
+import numpy as np
+
+MAX_INDEXES = 256 # per-image indexes kept in memory
+
+
+class BoxIndex:
+    """
+    Spatial index over the segments of one image.
+    Boxes are sorted by their top edge so region queries only look at boxes starting above the bottom of the region,
+    and bucketed by label so label queries do not scan every box.
+    """
+
+    def __init__(self, boxes: list):
+        """
+        boxes: the segments in the format of [(label, [score, [box]])...] with boxes as [x0, y0, x1, y1]
+        """
+        self.boxes = boxes
+        coords = np.array([value[1][1] for value in boxes], dtype=np.float64).reshape(-1, 4)
+        self.order = np.argsort(coords[:, 1], kind="stable") # by top edge
+        self.sorted = coords[self.order]
+        self.labels = {} # lowercase label -> indices into boxes, in segment order
+        self.rank = np.zeros(len(boxes), dtype=int) # index of each box among boxes with the same label
+        for i, value in enumerate(boxes):
+            bucket = self.labels.setdefault(value[0].lower(), [])
+            self.rank[i] = len(bucket)
+            bucket.append(i)
+
+    def label(self, label: str):
+        """
+        Gets the boxes with a label
+        label: the label, case insensitive
+        returns a list of indices into boxes
+        """
+        return self.labels.get(label.lower().strip(), [])
+
+    def _candidates(self, bottom: float):
+        n = np.searchsorted(self.sorted[:, 1], bottom, side="right") # boxes starting above the bottom edge
+        return self.order[:n], self.sorted[:n]
+
+    def _filter(self, indices: np.ndarray, label: str):
+        if label != "":
+            indices = indices[np.isin(indices, self.label(label))]
+        return sorted(indices.tolist())
+
+    def point(self, x: float, y: float, label: str = ""):
+        """
+        Finds the boxes containing a point
+        x, y: the point
+        label: (optional) only return boxes with this label
+        returns a list of indices into boxes, smallest box first
+        """
+        indices, c = self._candidates(y)
+        mask = (c[:, 0] <= x) & (x <= c[:, 2]) & (y <= c[:, 3])
+        found = self._filter(indices[mask], label)
+        return sorted(found, key=lambda i: self.area(i))
+
+    def overlaps(self, left: float, top: float, right: float, bottom: float, label: str = ""):
+        """
+        Finds the boxes overlapping a region
+        left, top, right, bottom: the region
+        label: (optional) only return boxes with this label
+        returns a list of indices into boxes
+        """
+        indices, c = self._candidates(bottom)
+        mask = (c[:, 0] < right) & (c[:, 2] > left) & (c[:, 1] < bottom) & (c[:, 3] > top) # touching edges do not overlap
+        return self._filter(indices[mask], label)
+
+    def within(self, left: float, top: float, right: float, bottom: float, label: str = ""):
+        """
+        Finds the boxes fully inside a region
+        left, top, right, bottom: the region
+        label: (optional) only return boxes with this label
+        returns a list of indices into boxes
+        """
+        indices, c = self._candidates(bottom)
+        mask = (c[:, 0] >= left) & (c[:, 1] >= top) & (c[:, 2] <= right) & (c[:, 3] <= bottom)
+        return self._filter(indices[mask], label)
+
+    def area(self, i: int):
+        x0, y0, x1, y1 = self.boxes[i][1][1]
+        return (x1 - x0) * (y1 - y0)
+
+    def describe(self, indices: list):
+        """
+        Formats boxes for the model
+        indices: indices into boxes
+        returns a list of [label, idx, score, box] where idx is the index to use with get_specific_segment
+        """
+        return [[self.boxes[i][0], int(self.rank[i]), self.boxes[i][1][0], self.boxes[i][1][1]] for i in indices]
+
+
+_indexes = OrderedDict() # segment cache key -> BoxIndex
+_lock = threading.Lock()
+
+
+def index_for(key: str, boxes: list):
+    """
+    Gets the spatial index of a segmentation result, building it once per result
+    key: the segment cache key of the result
+    boxes: the segments in the format of [(label, [score, [box]])...]
+    returns a BoxIndex
+    """
+    with _lock:
+        index = _indexes.get(key)
+        if index is not None:
+            _indexes.move_to_end(key)
+            return index
+    index = BoxIndex(boxes)
+    with _lock:
+        _indexes[key] = index
+        while len(_indexes) > MAX_INDEXES:
+            _indexes.popitem(last=False)
+    return index
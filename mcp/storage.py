@@ -0,0 +1,209 @@
+import os
+import re
+import time
+import shutil
+import tempfile
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+IMAGE_DIR = "images"
+MAX_BYTES = int(os.environ.get("STORAGE_MAX_BYTES", 10 * 1024 ** 3)) # total size of the images folder
+NAMESPACE_BYTES = int(os.environ.get("STORAGE_NAMESPACE_BYTES", 1024 ** 3)) # size of each conversation's images
+MAX_AGE = float(os.environ.get("STORAGE_MAX_AGE", 7 * 24 * 3600)) # seconds since an image was last used
+GC_INTERVAL = float(os.environ.get("STORAGE_GC_INTERVAL", 600)) # seconds between collections
+GRACE = 60 # images used this recently are never collected
+
+# The images folder is laid out as <namespace>/<source> for each uploaded image, with the outputs derived from it in
+# <namespace>/<source>/. filter.py names the namespaces and sources, the patterns below must accept its names.
+NAMESPACE = re.compile(r"^[0-9a-f]{12}$")
+NAME = re.compile(r"^([0-9a-f]{12}/)?[\w. -]+$")
+SOURCE_SUFFIXES = (".npy", ".txt", ".pdf")
+
+
+def check_name(file: str):
+    """
+    Checks that a file name passed to a tool stays inside the images folder
+    file: the image file name, either <source> or <namespace>/<source>
+    returns the file name
+    """
+    if not NAME.match(file) or file.split("/")[-1] in (".", ".."):
+        raise ValueError(f"invalid file name {file}")
+    return file
+
+
+def output_name(file: str, prefix: str):
+    """
+    Gets the name of an output derived from an image, stored next to the other outputs of the image
+    file: the source image file name
+    prefix: the output name, such as corrected
+    returns the output file name without the extension
+    """
+    return f"{check_name(file)}/{prefix}"
+
+
+def write_atomic(path: str, write, mode: str = "wb"):
+    """
+    Writes a file through a temporary file renamed into place, so readers never see a partial file
+    path: the file path, its folder is created if needed
+    write: function writing the contents to an open file
+    mode: the file mode
+    """
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, mode) as f:
+            write(f)
+        os.chmod(tmp, 0o644) # mkstemp files are private, httpd must be able to serve outputs
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def _size(path: str):
+    if os.path.isdir(path):
+        total = 0
+        for root, _, files in os.walk(path):
+            for f in files:
+                try:
+                    total += os.path.getsize(os.path.join(root, f))
+                except OSError: # removed while walking
+                    pass
+        return total
+    return os.path.getsize(path)
+
+
+class StorageManager:
+    """
+    Keeps the images folder within its size and age quotas. Each source image is removed together with the outputs
+    derived from it, least recently used first, in a background thread
+    """
+
+    def __init__(self, directory: str = IMAGE_DIR, max_bytes: int = MAX_BYTES, namespace_bytes: int = NAMESPACE_BYTES,
+                 max_age: float = MAX_AGE, interval: float = GC_INTERVAL):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.namespace_bytes = namespace_bytes
+        self.max_age = max_age
+        self.interval = interval
+        self.used = {} # source file name -> last time a tool used it
+        self.last = None # summary of the last collection
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def touch(self, file: str):
+        """
+        Marks an image as used
+        file: the image file name
+        """
+        self.used[file] = time.time()
+
+    def sources(self):
+        """
+        Lists the stored source images with their outputs
+        returns a list of (namespace, source file name, paths, bytes, last use)
+        """
+        found = []
+        spaces = [("", self.directory)]
+        with os.scandir(self.directory) as entries:
+            spaces += [(e.name, e.path) for e in entries if e.is_dir() and NAMESPACE.match(e.name)]
+        for space, folder in spaces:
+            groups = {} # source name -> paths
+            with os.scandir(folder) as entries:
+                for e in entries:
+                    if space == "" and NAMESPACE.match(e.name):
+                        continue
+                    name = e.name
+                    for suffix in SOURCE_SUFFIXES:
+                        if name.endswith(suffix):
+                            name = name[:-len(suffix)]
+                    groups.setdefault(name, []).append(e.path)
+            for name, paths in groups.items():
+                file = f"{space}/{name}" if space else name
+                try:
+                    size = sum(_size(p) for p in paths)
+                    last = max(max(os.path.getmtime(p) for p in paths), self.used.get(file, 0))
+                except OSError: # removed while scanning
+                    continue
+                found.append((space, file, paths, size, last))
+        return found
+
+    def _remove(self, paths: list):
+        for p in paths:
+            try:
+                if os.path.isdir(p):
+                    shutil.rmtree(p)
+                else:
+                    os.remove(p)
+            except OSError: # already removed
+                pass
+
+    def collect(self):
+        """
+        Removes the images and outputs over the age and size quotas, least recently used first
+        returns a dictionary with the number of removed sources and bytes
+        """
+        with self._lock:
+            start = time.time()
+            sources = sorted(self.sources(), key=lambda s: s[4]) # oldest first
+            removed, freed = 0, 0
+            keep = []
+            spaces = {}
+            for s in sources:
+                spaces[s[0]] = spaces.get(s[0], 0) + s[3]
+            total = sum(spaces.values())
+            for space, file, paths, size, last in sources:
+                age = start - last
+                over = total > self.max_bytes or (space != "" and spaces[space] > self.namespace_bytes)
+                if age > GRACE and (age > self.max_age or over):
+                    self._remove(paths)
+                    self.used.pop(file, None)
+                    spaces[space] -= size
+                    total -= size
+                    removed += 1
+                    freed += size
+                else:
+                    keep.append(space)
+            for space in set(spaces) - set(keep) - {""}: # empty namespaces
+                try:
+                    os.rmdir(os.path.join(self.directory, space))
+                except OSError:
+                    pass
+            self.last = {"time": round(start), "seconds": round(time.time() - start, 3), "sources": len(sources) - removed,
+                         "bytes": total, "removed": removed, "freed": freed}
+            if removed:
+                logger.info(f"storage collection removed {removed} images, {freed} bytes")
+            return self.last
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.collect()
+            except Exception as e:
+                logger.info(f"storage collection error: {e}")
+
+    def start(self):
+        """
+        Starts collecting in the background
+        """
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="storage-gc", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self):
+        """
+        Gets the quotas and the result of the last collection
+        returns a dictionary
+        """
+        return {"max_bytes": self.max_bytes, "namespace_bytes": self.namespace_bytes, "max_age": self.max_age, "last_collection": self.last}
+
+
+storage = StorageManager()
@@ -0,0 +1,142 @@
+import os
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+import numpy as np
+from PIL import Image
+import image as im
+from metrics import metrics
+from storage import storage, check_name
+
+logger = logging.getLogger(__name__)
+
+IMAGE_DIR = "images"
+MEMORY_BUDGET = int(os.environ.get("IMAGE_CACHE_BYTES", 512 * 1024 * 1024)) # bytes of decoded pixels kept in memory
+
+
+class ImageStore:
+    """
+    Process-wide LRU cache of decoded images shared by all tools.
+    Entries are keyed by file name and invalidated when the file's mtime or size changes,
+    so a chain of tool calls on one image only decodes it once.
+    """
+
+    def __init__(self, directory: str = IMAGE_DIR, budget: int = MEMORY_BUDGET):
+        self.directory = directory
+        self.budget = budget
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict() # file -> (stamp, array)
+        self._digests = {} # file -> (stamp, content hash)
+        self._lock = threading.Lock()
+
+    def path(self, file: str):
+        """
+        Gets the path of the stored image file
+        file: the image file name
+        returns the path to the file, preferring the raw .npy format over base64 .txt
+        """
+        base = os.path.join(self.directory, check_name(file))
+        if os.path.exists(base + ".npy"):
+            return base + ".npy"
+        return base + ".txt"
+
+    def _stamp(self, path: str):
+        st = os.stat(path)
+        return (st.st_mtime_ns, st.st_size)
+
+    def _decode(self, path: str):
+        a = im.load_array(os.path.splitext(path)[0])
+        a.setflags(write=False) # shared between callers, must not be modified in place
+        return a
+
+    def array(self, file: str):
+        """
+        Gets the decoded image as a read-only uint8 RGB numpy array
+        file: the image file name
+        returns a numpy array of shape (h, w, 3)
+        """
+        a = self._get(file)
+        metrics.record(shape=a.shape)
+        return a
+
+    def _get(self, file: str):
+        path = self.path(file)
+        storage.touch(file) # recently used images are collected last
+        stamp = self._stamp(path)
+        with self._lock:
+            entry = self._entries.get(file)
+            if entry is not None and entry[0] == stamp:
+                self._entries.move_to_end(file)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        a = self._decode(path)
+        self._insert(file, stamp, a)
+        return a
+
+    def pil(self, file: str):
+        """
+        Gets the decoded image as a PIL image
+        file: the image file name
+        returns an RGB PIL image
+        """
+        return Image.fromarray(self.array(file))
+
+    def digest(self, file: str):
+        """
+        Gets a hash of the decoded image content, so identical images share cached results whatever their file name or format
+        file: the image file name
+        returns a hex string
+        """
+        stamp = self._stamp(self.path(file))
+        with self._lock:
+            entry = self._digests.get(file)
+            if entry is not None and entry[0] == stamp:
+                return entry[1]
+        a = self._get(file)
+        h = hashlib.blake2b(digest_size=16)
+        h.update(str(a.shape).encode())
+        h.update(np.ascontiguousarray(a).data)
+        with self._lock:
+            self._digests[file] = (stamp, h.hexdigest())
+        return h.hexdigest()
+
+    def invalidate(self, file: str):
+        """
+        Removes an image from the cache
+        file: the image file name
+        """
+        with self._lock:
+            entry = self._entries.pop(file, None)
+            self._digests.pop(file, None)
+            if entry is not None:
+                self.used -= entry[1].nbytes
+
+    def _insert(self, file: str, stamp, a: np.ndarray):
+        with self._lock:
+            old = self._entries.pop(file, None)
+            if old is not None:
+                self.used -= old[1].nbytes
+            if a.nbytes > self.budget: # too large to ever fit, don't flush everything else for it
+                return
+            self._entries[file] = (stamp, a)
+            self.used += a.nbytes
+            while self.used > self.budget: # evict least recently used
+                key, (_, evicted) = self._entries.popitem(last=False)
+                self.used -= evicted.nbytes
+                logger.info(f"evicted {key} from image cache")
+
+    def stats(self):
+        """
+        Gets cache usage
+        returns a dictionary of cache statistics
+        """
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self.used, "budget": self.budget,
+                    "hits": self.hits, "misses": self.misses}
+
+
+store = ImageStore()
@@ -4,12 +4,25 @@ import image as im
 import numpy as np
 import os
 import requests
-from transformers import RTDetrV2ForObjectDetection, RTDetrImageProcessor
-import torch
 from PIL import Image
 from mcp.types import ImageContent
 import cv2
-import random
+import asyncio
+import time
+import io
+import zipfile
+from store import store
+from batcher import Batcher
+from models import ModelManager
+from segcache import SegmentCache, segment_key
+from outcache import OutputCache, output_key
+from executor import executor
+from metrics import metrics
+import documents
+from resolution import ResolutionPolicy, is_blank
+from storage import storage, output_name, check_name
+import encoder
+import spatial
 
 logger = logging.getLogger(__name__)
 
@@ -33,22 +46,188 @@ classes_map = {
     15: "Form",
     16: "Key-Value Region",
 }
-model_name = "ds4sd/docling-layout-heron"
+MAX_VARIANTS = 16 # simulations per simulate_all call
+model_name = os.environ.get("SEGMENT_MODEL", "ds4sd/docling-layout-heron") # hugging face name or local path of the layout model
 threshold = 0.6
-image_processor = RTDetrImageProcessor.from_pretrained(model_name)
-model = RTDetrV2ForObjectDetection.from_pretrained(model_name)
-boxdict = {}
+models = ModelManager(model_name) # loaded in the background once the server starts
+segcache = SegmentCache() # segmentation results keyed by image content, model and threshold
+policy = ResolutionPolicy() # input size of the model for each image
+outputs = OutputCache() # outputs of correct, simulate, crop, resize and visualize_segmentaton keyed by image content and arguments
+blanks = set() # segment keys of images found blank, only kept in memory so a wrong guess is never stored
+palette = im.label_palette(list(classes_map.values())) # fixed box colour of each label
+
+
+def detect(images: list, manager: ModelManager = None):
+    """ Runs the layout model on a batch of images
+    Args:
+        images: list of RGB PIL images
+        manager: (optional) the model to use instead of the server's model
+    returns a list with the segments found for each image in the format of [(label, [score, [box]])...]
+    """
+    import torch
+    image_processor, backend = (manager or models).get() # waits for the model if it is still loading
+    sizes = [policy.size(*img.size) for img in images]
+    results = [None] * len(images)
+    for size in sorted(set(sizes)): # one forward pass per input size
+        group = [i for i, s in enumerate(sizes) if s == size]
+        start = time.perf_counter()
+        inputs = image_processor(images=[images[i] for i in group], size={"height": size, "width": size}, return_tensors="pt")
+        outputs = backend(inputs["pixel_values"]) # Get outputs
+        policy.observe(size, len(group), time.perf_counter() - start)
+        found = image_processor.post_process_object_detection(
+            outputs, 
+            target_sizes=torch.tensor([images[i].size[::-1] for i in group]), # rescale boxes to each original image size
+            threshold=threshold,
+        ) 
+        for i, result in zip(group, found):
+            results[i] = result
+    outputs = []
+    for img, result in zip(images, results): # Format each result
+        output = []
+        w, h = img.size
+        for score, label_id, box in zip(
+            result["scores"], result["labels"], result["boxes"]
+        ):
+            score = round(score.item(), 2)
+            label = classes_map[label_id.item()]
+            x0, y0, x1, y1 = [round(i) for i in box.tolist()]
+            box = [min(max(x0, 0), w), min(max(y0, 0), h), min(max(x1, 0), w), min(max(y1, 0), h)] # boxes are not clamped to the image
+            output.append([label, (score, box)])
+        outputs.append(output)
+    return outputs
+
+
+batcher = Batcher(detect)
+
+
+def segment_options():
+    """ Gets the settings besides the model and threshold that change the segments found
+    returns a dictionary with the inference backend and the input size policy
+    """
+    return {"backend": models.backend, "sizes": policy.sizes, "budget": policy.budget}
+
+
+def lookup_segments(file: str):
+    """ Looks up the stored segmentation result for the current contents of an image
+    Args:
+        file: the image file name
+    returns the cache key and the segments found in the format of [(label, [score, [box]])...] or None if the image has not been segmented
+    """
+    key = segment_key(store.digest(file), model_name, threshold, segment_options())
+    if key in blanks:
+        return key, []
+    return key, segcache.get(key)
+
+
+def get_segments(file: str):
+    """ Gets the stored segmentation result for the current contents of an image
+    Args:
+        file: the image file name
+    returns the segments found in the format of [(label, [score, [box]])...] or None if the image has not been segmented
+    """
+    if file == "" or not os.path.exists(store.path(file)):
+        return None
+    return lookup_segments(file)[1]
+
+
+def get_index(file: str):
+    """ Gets the spatial index over the stored segments of an image
+    Args:
+        file: the image file name
+    returns a spatial.BoxIndex or None if the image has not been segmented
+    """
+    if file == "" or not os.path.exists(store.path(file)):
+        return None
+    key, boxes = lookup_segments(file)
+    if boxes is None:
+        return None
+    return spatial.index_for(key, boxes) # built once per segmentation result
+
+
+def segment_box(index, label: str, idx: int):
+    """ Gets the box of a segment by label and index
+    Args:
+        index: the spatial index of the image
+        label: the label of the segment
+        idx: the index of the segment among the segments with the same label
+    returns the box as [x0, y0, x1, y1] or an error message
+    """
+    indices = index.label(label)
+    if len(indices) == 0:
+        return f"item not found. Ensure that label input is correct. Labels found: {sorted(set(b[0] for b in index.boxes))}"
+    if idx >= len(indices) and len(indices) > 1: # a single segment is returned for any index
+        return f"index out of bounds. There are {len(indices)} total segments for {label}"
+    return index.boxes[indices[min(idx, len(indices) - 1)]][1][1]
+
+
+def memoized(operation: str, file: str, params: dict, compute):
+    """ Returns the stored output of a deterministic tool for the same image file, contents and arguments, or computes and stores it
+    Args:
+        operation: the output file prefix
+        file: the input image file name
+        params: the arguments changing the output
+        compute: function taking the output file name without extension and returning the markdown link
+    returns the markdown link of the output
+    """
+    key = output_key(file, store.digest(file), operation, {**params, **encoder.settings()})
+    link = outputs.get(key)
+    if link is None:
+        name = output_name(file, f"{operation}_{key[:12]}") # each argument combination has its own file
+        link = compute(name)
+        outputs.put(key, name, link)
+    return link
+
+
+async def segment_file(file: str, tool: str = "segment"):
+    """ Segments one image, reusing the stored result for identical images
+    Args:
+        file: the image file name
+        tool: the tool name the blocking steps are run under in the worker pool
+    returns the segments found in the format of [(label, [score, [box]])...]
+    """
+    key, output = await executor.run(tool, lookup_segments, file) # identical images are only segmented once
+    if output is None:
+        if await executor.run(tool, lambda: is_blank(store.array(file))): # nothing to find, skip the model
+            if len(blanks) > 10000:
+                blanks.clear()
+            blanks.add(key)
+            return []
+        img = await executor.run(tool, store.pil, file) # cached RGB PIL image
+        with metrics.stage("inference"):
+            output = await batcher.submit(img) # batched with concurrent segment calls
+        await executor.run(tool, segcache.put, key, output)
+    return output
 
 
 async def initialize_tools(mcp: FastMCP):
     logger.info("setup started")
     register_select(mcp)
+    models.start()
+    storage.start() # removes old images and outputs in the background
     logger.info("setup ended")
 
 
 def register_select(mcp):
 
     @mcp.tool()
+    @metrics.trace
+    async def health() -> dict:
+        """ Reports the status of the server.
+        returns the loading state and load time of the segmentation model, the image and segment cache usage and the worker pool queues
+        """
+        return {"segmentation_model": models.status(), "resolution": policy.stats(), "image_cache": store.stats(), "segment_cache": segcache.stats(),
+                "output_cache": outputs.stats(), "storage": storage.stats(), "executor": executor.stats()}
+
+    @mcp.tool()
+    async def stats() -> dict:
+        """ Reports per-tool performance statistics.
+        returns for each tool the number of calls and errors, the mean latency and mean time spent reading, decoding, computing and encoding in ms, and the bytes and pixels processed
+        """
+        metrics.dump()
+        return metrics.summary()
+
+    @mcp.tool()
+    @metrics.trace
     async def segment(file: str): 
         """ Segments the image into layout categories.
         Args:
@@ -57,142 +236,284 @@ def register_select(mcp):
         """
         # Open the images file
         try:
-            f = open("images/" + file + ".txt")
-            img = f.read()
-            img = im.conv64toim(img) # convert to RGB PIL imgae
-            img = img.convert("RGB")
-            
-            # Setup segmentation model
-            inputs = image_processor(images=[img], return_tensors="pt")
-            with torch.no_grad(), torch.autocast(device_type='cuda', dtype= float):
-                outputs = model(**inputs) # Get outputs
-            results = image_processor.post_process_object_detection(
-                outputs, 
-                target_sizes=torch.tensor([img.size[::-1]]),
-                threshold=threshold,
-            ) 
-            output = []
-            for result in results: # Format each result
-                for score, label_id, box in zip(
-                    result["scores"], result["labels"], result["boxes"]
-                ):
-                    score = round(score.item(), 2)
-                    label = classes_map[label_id.item()]
-                    box = [round(i) for i in box.tolist()]
-                    output.append([label, (score, box)])
-            global boxdict
-            boxdict[file] = output
+            output = await segment_file(file)
+            if len(output) == 0:
+                return "No segments were found, the image is empty"
             return f"The following segments were found {[val[0] for val in output]}"
         except Exception as e:
+            metrics.error(e)
             logger.info(f"Segmentation error: {e}")
             return f"Segmentation error: {e}"
+
+    @mcp.tool()
+    @metrics.trace
+    async def segment_document(ctx: Context, files: list[str] = [], pdf: str = "", dpi: int = 150):
+        """ Segments every page of a multi-page document. Pages are segmented in batches and each page's segments are reported as soon as it finishes.
+        Args:
+            files (list): the page images to be segmented, in page order
+            pdf (string): (optional) a PDF file in the images folder to segment instead of files. Each page is saved as an image file named <pdf>_page<n>
+            dpi (int): (default 150) the resolution PDF pages are rendered at, at most 300
+        returns the image file of each page and the segments found on it in the format of {file: [labels...]}. Each page file can be used with visualize_segmentaton and get_specific_segment
+        """
+        try:
+            if pdf != "":
+                count = await executor.run("segment_document", documents.page_count, pdf)
+                names = documents.page_names(pdf, count)
+            else:
+                names = list(files)
+            if len(names) == 0:
+                return "Please specify the page files or the pdf to segment"
+            for name in names: # before anything is read or written
+                check_name(name)
+            limit = asyncio.Semaphore(batcher.batch_size * 2) # pages rendered and decoded ahead of the model
+            done = 0
+
+            async def page(i: int, file: str):
+                nonlocal done
+                async with limit:
+                    if pdf != "": # rasterise lazily, only when the page is about to be segmented
+                        await executor.run("segment_document", documents.render_page, pdf, i, file, dpi)
+                    output = await segment_file(file, "segment_document")
+                done += 1
+                await ctx.report_progress(done, len(names))
+                await ctx.info(f"{file}: the following segments were found {[val[0] for val in output]}")
+                return file, output
+
+            results = await asyncio.gather(*[page(i, file) for i, file in enumerate(names)])
+            return {file: [val[0] for val in output] for file, output in results}
+        except Exception as e:
+            metrics.error(e)
+            logger.info(f"Document segmentation error: {e}")
+            return f"Document segmentation error: {e}"
         
     @mcp.tool()
-    async def visualize_segmentaton(ctx: Context, file: str = "") -> ImageContent:
+    @executor.tool
+    @metrics.trace
+    def visualize_segmentaton(ctx: Context, file: str = "", labels: list[str] = [], full_resolution: bool = False) -> ImageContent:
         """ Visualizes a segmented image by drawing bounding boxes onto the image
         Args:
             file (string): the image that has been segmented. If not provided, this should be the last inputted image in the conversation history. 
+            labels (list): (optional) only draw the segments with these labels, all segments if empty
+            full_resolution (bool): (default False) keep the full resolution, large outputs are otherwise downscaled to a preview
         returns an image with the boxes drawn designs
         """
         try:
-            boxes = boxdict.get(file, None)
+            boxes = get_segments(file)
             if boxes == None:
                 return("No segments found. Use the segment tool function first to find the segments for the image.")
             if file == "": 
                 return("Please specify which file to use")
-            f = open("images/" + file + ".txt") #read image into np array
-            img = f.read()
-            img = im.conv64toarray(img)
-            
-            for value in boxes: # draw bounding boxes
-                rgb = (random.randint(0, 1), random.randint(0, 1), random.randint(0, 1)) # random coloring
-                img = cv2.rectangle(img, (value[1][1][0], value[1][1][1]), (value[1][1][2], value[1][1][3]), rgb, 1)
-                cv2.putText(img, f"{value[0]}: {value[1][0]}", (value[1][1][0], value[1][1][1]), cv2.FONT_HERSHEY_PLAIN, 1, rgb, 2)
-            #PILimg = Image.fromarray(np.uint8(img)).convert('RGB') # convert to PIL image
-            save = "images/segment" + file + ".jpg" # save as new file
-            img = cv2.cvtColor(np.uint8(img *255), cv2.COLOR_RGB2BGR)
-            cv2.imwrite(save, img) 
-            return f"![image](http://localhost:8004/segment{file}.jpg)"
-            #return f"![image](data:image/jpeg;base64,{im.encode_image(PILimg)})"
+            wanted = sorted(set(l.lower().strip() for l in labels))
+            if wanted:
+                boxes = [b for b in boxes if b[0].lower() in wanted]
+                if len(boxes) == 0:
+                    return f"No segments with the labels {labels}. Labels found: {sorted(set(b[0] for b in get_segments(file)))}"
+
+            def compute(name):
+                img = store.array(file) # read image into np array
+                scale = 1 if full_resolution else encoder.preview_scale(img.shape)
+                with metrics.stage("compute"):
+                    out = im.overlay(img, scale) # drawn on the preview pixels only
+                    im.annotate(out, boxes, palette, scale)
+                link = encoder.save(out, name, full_resolution) # save as new file
+                return link + encoder.preview_note(img.shape) if scale < 1 else link
+
+            return memoized("segment", file, {"labels": wanted, "full_resolution": full_resolution, "model": model_name, "threshold": threshold, **segment_options()}, compute)
         except Exception as e:
+            metrics.error(e)
             logger.info(f"visualize segment error: {e}")
             return f"Visualize segmentation error: {e}"
     
     @mcp.tool()
-    async def get_specific_segment(label: str, ctx: Context, file: str = "", idx: int = 0) -> ImageContent:
+    @executor.tool
+    @metrics.trace
+    def get_specific_segment(label: str, ctx: Context, file: str = "", idx: int = 0, x: int = -1, y: int = -1, full_resolution: bool = False) -> ImageContent:
         """ Retrieves a segment of the image and saves it as a file. 
         Args:
             file (string): the image that has been segmented. Must have first called segment(). Can be retrieved through conversation history
             label (string): the label of the segment to retrieve
             idx: (optional default = 0) if there are multiple segments with the same label, the index of the specific segment to retrieve
+            x, y: (optional) a point in the image. If given, the smallest segment with the label containing the point is retrieved instead of idx
+            full_resolution (bool): (default False) keep the full resolution, large outputs are otherwise downscaled to a preview
         returns the image cropped to the region of the segment
         """
-        boxes = boxdict.get(file, None)
-        if boxes == None:
-            return("No segments found. Use the segment tool function first to find the segments for the image.")
-        if file == "": 
-            return("Please specify which file to use")
         lab = label.lower().strip()
         try: 
-            f = open("images/" + file + ".txt") # open image as np.array
-            img = f.read()
-            img = np.uint8(im.conv64toarray(img)*255)
+            index = get_index(file) # decodes and hashes the image, can fail like any other read
+            if index == None:
+                return("No segments found. Use the segment tool function first to find the segments for the image.")
+            if file == "": 
+                return("Please specify which file to use")
+            img = store.array(file) # cached uint8 np.array
     
-            # Get the boxes with corresponding label
-            indices = [i for i, val in enumerate(boxes) if val[0].lower() == lab]
-            if len(indices) == 0: # if no boxes are found
-                logger.info(f"item not found. Ensure that label input is correct. Bounding boxes: {boxes}. All possible labels: {classes_map}")
-                return f"item not found. Ensure that label input is correct. Bounding boxes: {boxes}. All possible labels: {classes_map}"
-            elif len(indices) == 1: # if there is only one box
-                i = indices[0]
-                img = img[boxes[i][1][1][1]:boxes[i][1][1][3], boxes[i][1][1][0]:boxes[i][1][1][2], :]
-            else: # if there are multiple boxes
-                if idx >= len(indices): # if provided index is greater than number of boxes
-                    logger.info(f"index out of bounds. There are {len(indices)} total segments for {label}")
-                    return f"index out of bounds. There are {len(indices)} total segments for {label}"
-                # get box at index 
-                i = indices[idx]
-                img = img[boxes[i][1][1][1]:boxes[i][1][1][3], boxes[i][1][1][0]:boxes[i][1][1][2], :]
-                #PILimg = Image.fromarray(np.uint8(img)).convert('RGB') 
-                #return f"The color corrected image file name is corected{file}"
-            save = "images/" + lab + file + ".jpg" # save as new file
+            # Get the box with corresponding label from the label bucket
+            if x >= 0 and y >= 0:
+                found = index.point(x, y, lab)
+                if len(found) == 0:
+                    logger.info(f"no {label} segment contains the point ({x}, {y})")
+                    return f"no {label} segment contains the point ({x}, {y}). Segments at this point: {index.describe(index.point(x, y))}"
+                box = index.boxes[found[0]][1][1]
+            else:
+                box = segment_box(index, lab, idx)
+                if isinstance(box, str): # label not found or index out of bounds
+                    logger.info(box)
+                    return box
+            img = img[box[1]:box[3], box[0]:box[2], :]
             img = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
-            cv2.imwrite(save, img) 
-            return f"![image](http://localhost:8004/{lab}{file}.jpg)"
+            return encoder.save(img, output_name(file, lab.replace(" ", "_")), full_resolution) # save as new file
         except Exception as e:
+            metrics.error(e)
             logger.info(f"get specific segment error: {e}")
             return f"get specific segment error: {e}"
+
+    @mcp.tool()
+    @metrics.trace
+    async def get_all_segments(file: str, label: str, bundle: str = ""):
+        """ Retrieves every segment of the image with a label at once and saves each as a file.
+        Args:
+            file (string): the image that has been segmented. Must have first called segment()
+            label (string): the label of the segments to retrieve, for example Table or Picture
+            bundle (string): (optional) "zip" to also bundle every segment into a single zip archive, "montage" to return a single image with every segment in a grid instead
+        returns the images cropped to the region of each segment, in the same order as the idx of get_specific_segment
+        """
+        if bundle not in ("", "zip", "montage"):
+            return 'bundle must be "", "zip" or "montage"'
+        lab = label.lower().strip()
+        name = lab.replace(" ", "_")
+        try:
+            index = await executor.run("get_all_segments", get_index, file)
+            if index is None:
+                return "No segments found. Use the segment tool function first to find the segments for the image."
+            box = segment_box(index, lab, 0)
+            if isinstance(box, str): # label not found
+                return box
+            img = await executor.run("get_all_segments", store.array, file) # decoded once for every segment
+            views = [img[max(b[1], 0):b[3], max(b[0], 0):b[2]] for b in (index.boxes[i][1][1] for i in index.label(lab))] # zero-copy slices
+            found = [i for i, v in enumerate(views) if v.size > 0] # idx of each segment with pixels
+            if len(found) == 0:
+                return f"every {label} segment is empty"
+            if bundle == "montage":
+                def montage():
+                    cell = (min(max(views[i].shape[0] for i in found), 1024), min(max(views[i].shape[1] for i in found), 1024), 3)
+                    with metrics.stage("compute"):
+                        sheet = im.contact_sheet((im.letterbox(views[i], cell) for i in found), [f"{label} {i}" for i in found], cell)
+                    return encoder.save(cv2.cvtColor(sheet, cv2.COLOR_RGB2BGR), output_name(file, f"{name}all"))
+                return await executor.run("get_all_segments", montage)
+
+            ext = encoder.extension()
+            def encode(i: int, view: np.ndarray):
+                with metrics.stage("encode"):
+                    buf = encoder.encode(cv2.cvtColor(view, cv2.COLOR_RGB2BGR))
+                    encoder.write(f"{output_name(file, f'{name}{i}')}.{ext}", buf)
+                return buf
+
+            encoded = await asyncio.gather(*[executor.run("get_all_segments", encode, i, views[i]) for i in found]) # encoded in parallel
+            links = [f"{label} {i}: ![image]({encoder.url(output_name(file, f'{name}{i}') + '.' + ext)})" for i in found]
+            if bundle == "zip":
+                def archive():
+                    data = io.BytesIO()
+                    with zipfile.ZipFile(data, "w", zipfile.ZIP_STORED) as z: # jpeg is already compressed
+                        for i, buf in zip(found, encoded):
+                            z.writestr(f"{name}{i}.{ext}", buf.tobytes())
+                    encoder.write(output_name(file, f"{name}s") + ".zip", data.getbuffer()) # never serve a partial archive
+                await executor.run("get_all_segments", archive)
+                links.append(f"all: [{name}s.zip]({encoder.url(output_name(file, f'{name}s') + '.zip')})")
+            logger.info(f"{len(found)} images stored at /images/{file}/{name}*.{ext}")
+            return "\n".join(links)
+        except Exception as e:
+            metrics.error(e)
+            logger.info(f"get all segments error: {e}")
+            return f"get all segments error: {e}"
+
+    @mcp.tool()
+    @executor.tool
+    @metrics.trace
+    def segments_at(file: str, x: int, y: int, label: str = ""):
+        """ Finds the segments containing a point of a segmented image.
+        Args:
+            file (string): the image that has been segmented. Must have first called segment()
+            x (int): the number of pixels from the left of the point
+            y (int): the number of pixels from the top of the point
+            label (string): (optional) only find segments with this label
+        returns the segments containing the point, smallest first, in the format of [[label, idx, score, box]...]. label and idx can be used with get_specific_segment
+        """
+        try:
+            index = get_index(file)
+            if index is None:
+                return "No segments found. Use the segment tool function first to find the segments for the image."
+            found = index.describe(index.point(x, y, label))
+            return found if len(found) > 0 else f"No segments contain the point ({x}, {y})"
+        except Exception as e:
+            metrics.error(e)
+            logger.info(f"segments at error: {e}")
+            return f"segments at error: {e}"
+
+    @mcp.tool()
+    @executor.tool
+    @metrics.trace
+    def find_segments(file: str, label: str = "", top: int = -1, bottom: int = -1, left: int = -1, right: int = -1,
+                      region_label: str = "", region_idx: int = 0, inside: bool = False):
+        """ Finds the segments of a segmented image in a region, for example all Text segments inside a Table or the segments overlapping a crop.
+        Args:
+            file (string): the image that has been segmented. Must have first called segment()
+            label (string): (optional) only find segments with this label
+            top, bottom, left, right (int): (optional) the region (y0, y1, x0, x1) to search. If not given, the whole image is searched
+            region_label (string): (optional) use the box of the segment with this label as the region instead
+            region_idx (int): (default 0) the index of the region segment if there are multiple segments with region_label
+            inside (bool): (default False) only find segments fully inside the region instead of every segment overlapping it
+        returns the segments found in the format of [[label, idx, score, box]...]. label and idx can be used with get_specific_segment
+        """
+        try:
+            index = get_index(file)
+            if index is None:
+                return "No segments found. Use the segment tool function first to find the segments for the image."
+            exclude = None
+            if region_label != "":
+                box = segment_box(index, region_label, region_idx)
+                if isinstance(box, str):
+                    return box
+                left, top, right, bottom = box
+                exclude = index.label(region_label)[min(region_idx, len(index.label(region_label)) - 1)] # the region segment itself
+            if top < 0 or bottom < 0 or left < 0 or right < 0: # whole image
+                found = index.label(label) if label != "" else list(range(len(index.boxes)))
+            elif inside:
+                found = index.within(left, top, right, bottom, label)
+            else:
+                found = index.overlaps(left, top, right, bottom, label)
+            found = index.describe([i for i in found if i != exclude])
+            return found if len(found) > 0 else "No segments found in the region"
+        except Exception as e:
+            metrics.error(e)
+            logger.info(f"find segments error: {e}")
+            return f"find segments error: {e}"
     
     @mcp.tool()
-    async def correct(file: str, dp: float = 1, dd: float = 1) -> str: 
+    @executor.tool
+    @metrics.trace
+    def correct(file: str, dp: float = 1, dd: float = 1, full_resolution: bool = False) -> str: 
         """ Applies a color-correcting filter onto a given image for colorblind vision
         Args:
             file (string): the inputted image
             dp (int): (default 1) the degree of protanopia colorblindness
             dd (int): (default 1) the degree of deuteranopia colorblindness
+            full_resolution (bool): (default False) keep the full resolution, large outputs are otherwise downscaled to a preview
         Returns:
             the color-corrected image in markdown format
         """
-        correction = np.array([[1 - dd/2, dd/2, 0],
-                         [dp/2, 1 - dd, 1-dp/2 * dd],
-                         [dp/4, dd/4, 1 - (dp + dd)/4]]).T # correction matrix
+        correction = im.correction_matrix(dp, dd) # correction matrix
         
         # open file
         try:
-            f = open("images/" + file + ".txt") 
-            img = f.read() # read image
-            img = im.conv64toarray(img)
-            img = np.uint8(np.dot(img, correction) * 255) # apply correction
-            PILimg = Image.fromarray(np.uint8(img)).convert('RGB')
-            
-            save = "images/corrected" + file + ".jpg" # save file
-            img = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
-            cv2.imwrite(save, img)
-            logger.info(f"Image stored at /images/corected{file}.jpg")
-            #return f"The color corrected image file name is corected{file}"
-            #data:image/jpeg;base64,{im.encode_image(PILimg)}
-            return f"![image](http://localhost:8004/corrected{file}.jpg)"
+            def compute(name):
+                img = store.array(file) # read image
+                with metrics.stage("compute"):
+                    img = im.transform(img, correction, bgr=True) # apply correction, output bgr for cv2
+                #return f"The color corrected image file name is corected{file}"
+                #data:image/jpeg;base64,{im.encode_image(PILimg)}
+                return encoder.save(img, name, full_resolution) # save file
+            return memoized("corrected", file, {"dp": dp, "dd": dd, "full": full_resolution}, compute)
         except Exception as e:
+            metrics.error(e)
             logger.info(f"Image correct error: {e}")
             return f"Image correct error: {e}"
     
@@ -200,48 +521,102 @@ def register_select(mcp):
         
     
     @mcp.tool()
-    async def simulate(file: str, color: str, degree: float):
+    @executor.tool
+    @metrics.trace
+    def simulate(file: str, color: str, degree: float, full_resolution: bool = False):
         """ Simulates an image in colorblind vision. 
         Args:
             file (string): the inputted imgae
             color (string) : the type of colorblindness
             degree (string) : the degree of colorblindness
+            full_resolution (bool): (default False) keep the full resolution, large outputs are otherwise downscaled to a preview
         Returns:
             The markdown image simulated in colorblind vision
         """
-        matrix = []
-        match color: # get colorblindness matrix
-            case "protanopia":
-                matrix = im.protanopia(degree)
-            case "deuteranopia":
-                matrix = im.deuteranopia(degree)
-            case "tritanopia":
-                matrix = im.tritanopia(degree)
-            case "achromatopsia":
-                matrix = im.achromatopsia()
-            case __:
-                logger.info("color blindness type not found")
+        matrix = im.simulation_matrix(color, degree) # fused rgb->lms->filter->rgb matrix
+        if matrix is None:
+            logger.info("color blindness type not found")
+            return f"color blindness type not found. Possible types: {list(colortype)}"
         try:
-            f = open("images/" + file + ".txt") # open file
-            img = f.read()
-            img = im.conv64toarray(img)
-            
-            imglms = np.dot(img[:,:,:3], im.lms()) # convert to lms colorspace
-            imglms = np.uint8(np.dot(img, matrix)) # apply filter
-            imgrgb = np.uint8(np.dot(imglms, im.rgb()) * 255) # convert back to RGB
-            # PILimg = Image.fromarray(np.uint8(imgrgb)).convert('RGB')
-            img = cv2.cvtColor(imgrgb, cv2.COLOR_RGB2BGR)
-            cv2.imwrite("images/simulated" + file + ".jpg", img) # save image
-            logger.info(f"Image stored at /images/simulated{file}.jpg")
-            return f"![image](http://localhost:8004/simulated{file}.jpg)"
-        except Exception as e: 
+            def compute(name):
+                img = store.array(file) # read image
+                with metrics.stage("compute"):
+                    img = im.transform(img, matrix, bgr=True) # simulate in one pass, output bgr for cv2
+                return encoder.save(img, name, full_resolution) # save image
+            return memoized("simulated", file, {"color": color, "degree": degree, "full": full_resolution}, compute)
+        except Exception as e:
+            metrics.error(e)
             logger.info(f"Image simulate error: {e}")
             return f"Image simulate error: {e}"
         #return f"![image](data:image/jpeg;base64,{im.encode_image(PILimg)})"
 
 
     @mcp.tool()
-    async def crop(file: str, ctx: Context, top: int = 0, bottom: int = 0, left: int = 0, right: int = 0):
+    @executor.tool
+    @metrics.trace
+    def simulate_all(file: str, colors: list[str] = list(colortype), degrees: list[float] = [1.0], contact_sheet: bool = True, full_resolution: bool = False):
+        """ Simulates an image in several types of colorblind vision at once.
+        Args:
+            file (string): the inputted image
+            colors (list): (default all types) the types of colorblindness to simulate
+            degrees (list): (default [1.0]) the degrees of colorblindness to simulate for each type
+            contact_sheet (bool): (default True) return a single image with every simulation side by side instead of one image per simulation
+            full_resolution (bool): (default False) keep the full resolution, large outputs are otherwise downscaled to a preview
+        Returns:
+            The markdown images simulated in colorblind vision
+        """
+        variants = []
+        for color in colors: # every type and degree combination
+            for degree in ([1.0] if color == "achromatopsia" else degrees): # achromatopsia has no degree
+                matrix = im.simulation_matrix(color, degree)
+                if matrix is None:
+                    logger.info("color blindness type not found")
+                    return f"color blindness type {color} not found. Possible types: {list(colortype)}"
+                variants.append((color, degree, matrix))
+        if len(variants) == 0:
+            return f"Please specify at least one type and degree of colorblindness. Possible types: {list(colortype)}"
+        if len(variants) > MAX_VARIANTS:
+            return f"Too many simulations ({len(variants)}), at most {MAX_VARIANTS} types and degrees can be simulated at once"
+        try:
+            if contact_sheet:
+                labels = [color if color == "achromatopsia" else f"{color} {degree}" for color, degree, _ in variants]
+
+                def compute(name):
+                    img = store.array(file) # decode once for every variant
+                    cols = int(np.ceil(np.sqrt(len(variants))))
+                    rows = int(np.ceil(len(variants) / cols))
+                    h, w = img.shape[:2]
+                    scale = 1 if full_resolution else encoder.preview_scale((rows * h, cols * w))
+                    with metrics.stage("compute"):
+                        if scale < 1: # each cell at its share of the preview, the colour matrices are per pixel
+                            img = cv2.resize(img, (max(1, int(w * scale)), max(1, int(h * scale))), interpolation=cv2.INTER_AREA)
+                        cells = (im.transform(img, matrix, bgr=True) for _, _, matrix in variants) # one variant in memory at a time
+                        sheet = im.contact_sheet(cells, labels, img.shape, cols)
+                    link = encoder.save(sheet, name, full_resolution) # save image
+                    return link + encoder.preview_note((rows * h, cols * w)) if scale < 1 else link
+
+                params = {"variants": [[color, degree] for color, degree, _ in variants], "full": full_resolution}
+                return memoized("simulatedall", file, params, compute)
+            links = []
+            for color, degree, matrix in variants: # shared with the outputs of simulate
+                def compute(name, matrix=matrix):
+                    img = store.array(file)
+                    with metrics.stage("compute"):
+                        out = im.transform(img, matrix, bgr=True)
+                    return encoder.save(out, name, full_resolution)
+                link = memoized("simulated", file, {"color": color, "degree": degree, "full": full_resolution}, compute)
+                links.append((f"{color} {degree}", link))
+            return "\n".join(f"{name}: {link}" for name, link in links)
+        except Exception as e:
+            metrics.error(e)
+            logger.info(f"Image simulate error: {e}")
+            return f"Image simulate error: {e}"
+
+
+    @mcp.tool()
+    @executor.tool
+    @metrics.trace
+    def crop(file: str, ctx: Context, top: int = 0, bottom: int = 0, left: int = 0, right: int = 0, segments: bool = False, full_resolution: bool = False):
         """ Crops an image. 
         Args: 
             file (string): the inputted image file
@@ -249,48 +624,57 @@ def register_select(mcp):
             bottom (int): the number of pixels from the top to the lower bound of the region being cropped (y1) (default 0)
             left (int): the number of pixels from the left to the left bound of the region being cropped  (x0) (default 0)
             right (int): the number of pixels from the left to the right bound of the region being cropped (x1) (default 0)
+            segments (bool): (default False) also list the segments overlapping the cropped region, with boxes relative to the cropped image. The image must have been segmented
+            full_resolution (bool): (default False) keep the full resolution, large outputs are otherwise downscaled to a preview
 
         Returns:
             string: The image link formatted in markdown containing the image stored in `file` cropped to the region of interest designated by the crop box: (top:bottom, left:right)
         """
         try:
-            f = open("images/" + file + ".txt") # open file
-            img = f.read()
-            img = im.conv64toarray(img)
-            img = img[top:bottom, left:right]
-            img = cv2.cvtColor(imgrgb, cv2.COLOR_RGB2BGR)
-            cv2.imwrite("images/cropped" + file + ".jpg", img) # save image
-            logger.info(f"Image stored at /images/cropped{file}.jpg")
-            return f"![image](http://localhost:8004/cropped{file}.jpg)"
+            def compute(name):
+                img = store.array(file) # read image
+                with metrics.stage("compute"):
+                    img = im.crop(img, top, bottom, left, right, bgr=True) # crop band by band, output bgr for cv2
+                return encoder.save(img, name, full_resolution) # save image
+            link = memoized("cropped", file, {"top": top, "bottom": bottom, "left": left, "right": right, "full": full_resolution}, compute)
+            if segments:
+                index = get_index(file)
+                if index is None:
+                    return link + "\nNo segments found. Use the segment tool function first to find the segments for the image."
+                found = index.describe(index.overlaps(left, top, right, bottom))
+                for value in found: # relative to the crop
+                    x0, y0, x1, y1 = value[3]
+                    value[3] = [max(x0 - left, 0), max(y0 - top, 0), min(x1, right) - left, min(y1, bottom) - top]
+                return link + f"\nSegments in the cropped region: {found}"
+            return link
         except Exception as e:
+            metrics.error(e)
             logger.info(f"Image crop error: {e}")
             return f"Image crop error: {e}"
                         
 
-@mcp.tool()
-async def resize(file: str, ctx: Context, size: tuple[int, int] = (0, 0), scale_x: int = 1, scale_y: int = 1):
-    """ Resizes an image. 
-        Args: 
-            file (string): the inputted image file
-            size (tuple): the size (x, y) to resize the image to. If size is (0, 0), then scale factors will be used instead.
-            scale_x (int): the scale to horizontally resize the image by. (default 1)
-            scale_y (int): the scale to vertically resize the image by. To keep the aspect ratio, this input should be equal to scale_x (default 1)
+    @mcp.tool()
+    @executor.tool
+    @metrics.trace
+    def resize(file: str, ctx: Context, size: tuple[int, int] = (0, 0), scale_x: int = 1, scale_y: int = 1):
+        """ Resizes an image. 
+            Args: 
+                file (string): the inputted image file
+                size (tuple): the size (x, y) to resize the image to. If size is (0, 0), then scale factors will be used instead.
+                scale_x (int): the scale to horizontally resize the image by. (default 1)
+                scale_y (int): the scale to vertically resize the image by. To keep the aspect ratio, this input should be equal to scale_x (default 1)
             
-        Returns:
-            string: The image link formatted in markdown containing the resized image using bilinear interpolation
-        """
-    try:
-        f = open("images/" + file + ".txt") # open file
-        img = f.read()
-        img = im.conv64toarray(img)
-        if size != (0, 0): # if resizing by size
-            img = cv2.resize(img, size)
-        else: # if resizing by scale factor
-            img = cv2.resize(img, None, fx = scale_x, fy = scale_y, interpolation=cv2.INTER_LINEAR) # bilinear interp
-        img = cv2.cvtColor(imgrgb, cv2.COLOR_RGB2BGR) # convert color
-        cv2.imwrite("images/resized" + file + ".jpg", img) # save image
-        logger.info(f"Image stored at /images/resized{file}.jpg") 
-        return f"![image](http://localhost:8004/resized{file}.jpg)"
-    except Exception as e:
-            logger.info(f"Image crop error: {e}")
-            return f"Image crop error: {e}"
\ No newline at end of file
+            Returns:
+                string: The image link formatted in markdown containing the resized image using bilinear interpolation
+            """
+        try:
+            def compute(name):
+                img = store.array(file) # read image
+                with metrics.stage("compute"):
+                    img = im.resize(img, size, scale_x, scale_y, bgr=True) # bilinear interp band by band, output bgr for cv2
+                return encoder.save(img, name, pixels=0) # save image at the requested size
+            return memoized("resized", file, {"size": list(size), "scale_x": scale_x, "scale_y": scale_y}, compute)
+        except Exception as e:
+                metrics.error(e)
+                logger.info(f"Image crop error: {e}")
+                return f"Image crop error: {e}"
\ No newline at end of file